@@ -7,7 +7,11 @@ from core import (
     WILDFIRE_DB,
     ROAD_CLOSURE_DB,
     get_db_connection,
+    db_stats,
 )
+from routing import remove_road_closure
+import events
+import fire
 
 # Blueprint for all administrator-only endpoints
 admin_bp = Blueprint("admin", __name__)
@@ -41,9 +45,12 @@ def admin_delete_user():
         return jsonify({"error": "Username required"}), 400
 
     conn = get_db_connection(USER_DB)
-    conn.execute("DELETE FROM users WHERE username = ?", (username,))
+    row = conn.execute("DELETE FROM users WHERE username = ? RETURNING latitude, longitude",
+                       (username,)).fetchone()
     conn.commit()
     conn.close()
+    if row:
+        events.publish("user", {"op": "deleted", "username": username}, *row)
 
     return jsonify({"message": f"User {username} deleted"}), 200
 
@@ -58,9 +65,12 @@ def admin_delete_fire():
         return jsonify({"error": "Fire ID required"}), 400
 
     conn = get_db_connection(WILDFIRE_DB)
-    conn.execute("DELETE FROM wildfires WHERE id = ?", (fid,))
+    row = conn.execute("DELETE FROM wildfires WHERE id = ? RETURNING latitude, longitude",
+                       (fid,)).fetchone()
     conn.commit()
     conn.close()
+    if row:
+        events.publish("fire", {"op": "deleted", "id": int(fid)}, *row)
 
     return jsonify({"message": f"Wildfire {fid} deleted"}), 200
 
@@ -73,14 +83,43 @@ def admin_delete_road_closure():
     cid = request.json.get("id")
     if not cid:
         return jsonify({"error": "Road closure ID required"}), 400
+    try:
+        cid = int(cid)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Road closure ID must be an integer"}), 400
 
     conn = get_db_connection(ROAD_CLOSURE_DB)
-    conn.execute("DELETE FROM road_closures WHERE id = ?", (cid,))
+    row = conn.execute("DELETE FROM road_closures WHERE id = ? RETURNING latitude, longitude",
+                       (cid,)).fetchone()
     conn.commit()
     conn.close()
+    remove_road_closure(cid)
+    if row:
+        events.publish("road_closure", {"op": "deleted", "id": cid}, *row)
 
     return jsonify({"message": f"Road closure {cid} deleted"}), 200
 
+# Ingest rows appended to the FIRMS CSV since the last ingest
+@admin_bp.post("/api/admin_ingest_fires")
+def admin_ingest_fires():
+    if "admin" not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    try:
+        new, rejected = fire.refresh_fires()
+    except (OSError, ValueError) as e:
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({"added": len(new), "rejected": rejected}), 200
+
+# Per-statement query counts and timings (SQL text included, so admin only)
+@admin_bp.get("/api/admin_db_stats")
+def admin_db_stats():
+    if "admin" not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    return jsonify(db_stats()), 200
+
 __all__ = [
     "admin_bp",
 ]
\ No newline at end of file
@@ -1,21 +1,86 @@
+import gzip
+import hashlib
+import io
+import json
 import math
-from flask import Blueprint, request, jsonify, session
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+from functools import lru_cache
+from flask import Blueprint, Response, request, jsonify, session
 from core import (
-    _graph_edges, _graph_nodes, _mesh_gdf, _nearest_node, _fire_layers_cached,
-    G_ROUTE, P_DB, ROAD_CLOSURE_DB, WILDFIRE_DB,
-    USER_DB, VEHICLE_DB, haversine_distance, get_db_connection
+    _nearest_node, _fire_layers_cached,
+    ROAD_CLOSURE_DB, WILDFIRE_DB,
+    USER_DB, VEHICLE_DB, get_db_connection,
+    snap_points, MAX_SNAP_M, clip_layer_geojson,
+    _buildings_gdf, fire_records_in_bbox, bbox_clause,
+    table_version, changes_since
+)
+import events
+import jobs
+from service import allocate_nearest_vehicles   # also registers the job handlers
+from routing import (
+    ROUTE_CACHE, shortest_route, path_lonlat, apply_road_closure, apply_road_closures,
+    route_matrix, isochrone
 )
-from service import notify_users_nearby, allocate_vehicles_for_fire
-import networkx as nx
 from shapely.geometry import box, LineString
 from admin_api import admin_bp
+from tiles import tiles_bp
 
 api_bp = Blueprint("api", __name__)
 api_bp.register_blueprint(admin_bp)
-
+api_bp.register_blueprint(tiles_bp)
+
+# Gzipped body if the client takes it, otherwise the plain bytes
+def _gzip_response(gz, etag, mimetype="application/json"):
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(gz, mimetype=mimetype, headers=headers)
+    return Response(gzip.decompress(gz), mimetype=mimetype, headers=headers)
+
+# Buildings smaller than this many screen pixels are dropped from bbox views
+FIRE_LAYER_MIN_ZOOM = 12          # below this a bbox view carries no buildings
+FIRE_LAYER_MIN_PX = 1.0
+
+@lru_cache(maxsize=1)
+def _building_side_m():
+    return np.sqrt(_buildings_gdf()["area_sqft"].to_numpy(dtype=float)) / 3.28084
+
+# Whole overlay, or ?bbox=minlon,minlat,maxlon,maxlat[&zoom=z] for the view
 @api_bp.route("/api/fire_layers")
 def api_fire_layers():
-    return jsonify(_fire_layers_cached())
+    gz, etag = _fire_layers_cached()
+    if "bbox" not in request.args:
+        return _gzip_response(gz, etag)
+
+    try:
+        x0, y0, x1, y1 = (float(v) for v in request.args["bbox"].split(","))
+        zoom = int(request.args.get("zoom", 18))
+    except ValueError:
+        return jsonify({"error": "bbox=minlon,minlat,maxlon,maxlat and integer zoom"}), 400
+    view_etag = f'W/"{etag[1:-1]}-{x0},{y0},{x1},{y1}-{zoom}"'
+    if view_etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers={"ETag": view_etag})
+
+    if zoom < FIRE_LAYER_MIN_ZOOM:
+        buildings = '{"type":"FeatureCollection","features":[]}'
+    else:
+        # ground metres per pixel at this zoom/latitude (Web Mercator)
+        m_px = 156_543.03 * math.cos(math.radians((y0 + y1) / 2)) / 2 ** zoom
+        keep = _building_side_m() >= FIRE_LAYER_MIN_PX * m_px
+        buildings = clip_layer_geojson("buildings", box(x0, y0, x1, y1), keep)
+    fires = fire_records_in_bbox(x0, y0, x1, y1)
+
+    body = ('{"buildings":' + buildings + ',"fires":' + json.dumps(fires) + "}").encode()
+    return _gzip_response(gzip.compress(body, compresslevel=5), view_etag)
+
+FIRE_KEY_DECIMALS = 3          # ~100 m: reports this close count as the same fire
+
+def _merge_fire_reports(queued, new):
+    return {**queued, "fire_ids": queued["fire_ids"] + new["fire_ids"]}
 
 @api_bp.route("/api/add_fire", methods=["POST"])
 def add_fire():
@@ -27,6 +92,10 @@ def add_fire():
 
     if lat is None or lng is None:
         return jsonify({"error": "Latitude and Longitude are required."}), 400
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Latitude and Longitude must be numbers."}), 400
 
     # Insert wildfire into DB
     conn = get_db_connection(WILDFIRE_DB)
@@ -36,41 +105,300 @@ def add_fire():
            VALUES (?, ?, ?, ?)""",
         (lat, lng, desc, reason)
     )
+    fid = cursor.lastrowid
     conn.commit()
     conn.close()
+    events.publish("fire", {"op": "added", "id": fid, "latitude": lat, "longitude": lng,
+                            "description": desc, "reason": reason}, lat, lng)
 
-    # Notify users
-    notified_users = notify_users_nearby(lat, lng)
-
-    # Allocate vehicles
-    vehicle_info = allocate_vehicles_for_fire(lat, lng)
+    # Notify users / allocate vehicles in the background. Reports of the same
+    # fire (same spot, rounded) arriving before that job starts share it.
+    key = f"fire:{round(lat, FIRE_KEY_DECIMALS)},{round(lng, FIRE_KEY_DECIMALS)}"
+    job_id = jobs.submit("fire_response",
+                         {"fire_ids": [fid], "latitude": lat, "longitude": lng},
+                         key=key, merge=_merge_fire_reports)
 
     return jsonify({
         "message": "Fire added successfully",
-        "notified_users": notified_users,
-        "allocated_vehicles": vehicle_info
-    }), 201
+        "fire_id": fid,
+        "job_id": job_id,
+        "status_url": f"/api/jobs/{job_id}"
+    }), 202, {"Location": f"/api/jobs/{job_id}"}
+
+# Status / result of a background job
+@api_bp.route("/api/jobs/<int:job_id>")
+def get_job(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(job)
+
+# Bulk ingestion
+# POST a JSON array, CSV (text/csv) or NDJSON (application/x-ndjson) body, or
+# the same as a multipart "file" upload. The rows are checked together as one
+# DataFrame; valid rows go in with a single executemany in one transaction,
+# invalid ones are skipped and reported by row index.
+BULK_MAX_ROWS = 50000
+BULK_MAX_ERRORS = 100         # rejected rows listed in the response
+LAT_LNG_RANGES = {"latitude": (-90.0, 90.0), "longitude": (-180.0, 180.0)}
+
+def _read_bulk():
+    upload = request.files.get("file")
+    if upload is not None:
+        raw, name, ctype = upload.read(), upload.filename or "", upload.mimetype or ""
+    else:
+        raw, name, ctype = request.get_data(), "", request.mimetype or ""
+    if not raw.strip():
+        raise ValueError("empty body")
+    if "csv" in ctype or name.endswith(".csv"):
+        return pd.read_csv(io.BytesIO(raw))
+    if "ndjson" in ctype or "jsonl" in ctype or name.endswith((".ndjson", ".jsonl")):
+        return pd.read_json(io.BytesIO(raw), lines=True, dtype=False)
+    rows = json.loads(raw)
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        raise ValueError("expected a JSON array of objects")
+    return pd.DataFrame.from_records(rows)
+
+def _validate_bulk(df, numeric, text, integer=()):
+    """
+    numeric: column -> (lo, hi), required; text: column -> default.
+    Returns (valid rows with just those columns, [{"row", "error"}, ...], rejected count).
+    """
+    out = pd.DataFrame(index=df.index)
+    error = pd.Series(None, index=df.index, dtype=object)
+    for col, (lo, hi) in numeric.items():
+        vals = pd.to_numeric(df[col], errors="coerce") if col in df else pd.Series(np.nan, index=df.index)
+        ok = vals.between(lo, hi)                 # NaN (missing/unparsable) fails too
+        if col in integer:
+            ok &= vals % 1 == 0
+        error = error.mask(~ok & error.isna(), f"{col} must be a number in [{lo}, {hi}]"
+                           + (" (integer)" if col in integer else ""))
+        out[col] = vals
+    for col, default in text.items():
+        vals = df[col] if col in df else pd.Series(None, index=df.index, dtype=object)
+        out[col] = vals.where(vals.notna(), default).astype(str)
+
+    bad = error.notna()
+    errors = [{"row": int(i), "error": e} for i, e in error[bad].head(BULK_MAX_ERRORS).items()]
+    out = out[~bad]
+    for col in integer:
+        out[col] = out[col].astype(np.int64)
+    return out, errors, int(bad.sum())
+
+def _bulk_insert(db_name, table, df):
+    """Insert every row of `df` in one transaction; returns the new ids in row order."""
+    cols = list(df.columns)
+    conn = get_db_connection(db_name)
+    try:
+        # the write lock is held from here, so ids above `last` are all ours
+        conn.execute("BEGIN IMMEDIATE")
+        last = conn.execute(f"SELECT IFNULL(MAX(id), 0) FROM {table}").fetchone()[0]
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+            df.itertuples(index=False, name=None))
+        ids = [r[0] for r in conn.execute(
+            f"SELECT id FROM {table} WHERE id > ? ORDER BY id", (last,))]
+        conn.commit()
+    finally:
+        conn.close()                  # rolls back if anything above failed
+    return ids
+
+def _bulk_request(numeric, text, integer=()):
+    """Parse + validate the upload; returns (rows, errors, rejected) or an error response."""
+    try:
+        df = _read_bulk()
+    except ValueError as e:
+        return jsonify({"error": f"expected a JSON array, CSV or NDJSON body: {e}"}), 400
+    if len(df) > BULK_MAX_ROWS:
+        return jsonify({"error": f"at most {BULK_MAX_ROWS} rows per request"}), 413
+    rows, errors, rejected = _validate_bulk(df.reset_index(drop=True), numeric, text, integer)
+    if rows.empty:
+        return jsonify({"error": "no valid rows", "rejected": rejected, "errors": errors}), 400
+    return rows, errors, rejected
+
+@api_bp.route("/api/add_fires", methods=["POST"])
+def add_fires():
+    parsed = _bulk_request(LAT_LNG_RANGES,
+                           {"description": "Wildfire Alert", "reason": "Unknown Cause"})
+    if not isinstance(parsed[0], pd.DataFrame):
+        return parsed
+    rows, errors, rejected = parsed
+    ids = _bulk_insert(WILDFIRE_DB, "wildfires", rows)
+    events.publish_many("fire", [
+        ({"op": "added", "id": fid, **r}, r["latitude"], r["longitude"])
+        for fid, r in zip(ids, rows.to_dict("records"))
+    ])
+
+    # one background job notifies/allocates for the whole batch
+    job_id = jobs.submit("fire_response_batch", {"fires": [
+        {"fire_id": fid, "latitude": lat, "longitude": lng}
+        for fid, lat, lng in zip(ids, rows["latitude"].tolist(), rows["longitude"].tolist())
+    ]})
+
+    return jsonify({
+        "message": f"{len(ids)} fires added",
+        "fire_ids": ids,
+        "rejected": rejected,
+        "errors": errors,
+        "job_id": job_id,
+        "status_url": f"/api/jobs/{job_id}"
+    }), 202, {"Location": f"/api/jobs/{job_id}"}
+
+# Push stream (Server-Sent Events)
+#   /api/stream[?bbox=minlon,minlat,maxlon,maxlat][&types=fire,road_closure,...]
+# Events: fire / road_closure / user ({"op": "added"|"deleted", ...}),
+# allocation (a fire's background job finished) and resync – this client
+# missed events (its buffer overflowed, or a bulk upload was too large to
+# send row by row), so it should re-fetch the lists with ?since_version=.
+@api_bp.route("/api/stream")
+def api_stream():
+    try:
+        bbox = None
+        if "bbox" in request.args:
+            bbox = tuple(float(v) for v in request.args["bbox"].split(","))
+            if len(bbox) != 4:
+                raise ValueError
+    except ValueError:
+        return jsonify({"error": "bbox=minlon,minlat,maxlon,maxlat"}), 400
+    types = set(request.args["types"].split(",")) if "types" in request.args else None
+    sub = events.subscribe(bbox, types)
+    if sub is None:
+        return jsonify({"error": "too many stream clients"}), 503
+
+    def generate():
+        try:
+            yield f"retry: {events.EVENT_RETRY_MS}\n\n"
+            while True:
+                frames, dropped = sub.wait(events.EVENT_KEEPALIVE_S)
+                if dropped:
+                    yield events.frame("resync", {"dropped": dropped})
+                yield "".join(frames) if frames else ": keepalive\n\n"
+        finally:
+            events.unsubscribe(sub)
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# List endpoints
+# Optional filters shared by the list endpoints:
+#   ?bbox=minlon,minlat,maxlon,maxlat   R*Tree lookup (minlon > maxlon wraps the antimeridian)
+#   ?since=<ISO-8601 | epoch seconds>   rows inserted/modified since then
+#   ?after_id=N&limit=M                 keyset paging; X-Next-After-Id carries the cursor
+#   ?format=ndjson                      one JSON object per line instead of an array
+#   ?since_version=V                    delta: {"version", "upserts", "deletes"} since V
+# Rows are streamed from the cursor in batches, never built into one list.
+# Every response carries X-Change-Version and an ETag derived from it, so an
+# unchanged table answers a conditional poll with 304.
+LIST_MAX_LIMIT = 5000
+LIST_FETCH_ROWS = 500
+
+def _parse_since(text):
+    try:
+        dt = datetime.fromtimestamp(float(text), timezone.utc)
+    except ValueError:
+        dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+        dt = dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+def _list_delta(conn, table, fields, since_version, version, headers):
+    if since_version > version:          # client saw a different database: full reload
+        return jsonify({"error": "since_version is ahead of the table; reload"}), 410
+    cols = ", ".join("t." + f for f in fields if f != "id")
+    upserts, deletes, new_version = changes_since(conn, table, since_version, cols)
+    body = {
+        "version": new_version,
+        "upserts": [{"id": r["change_row"], **{f: r[f] for f in fields if f != "id"}}
+                    for r in upserts],
+        "deletes": deletes,
+    }
+    return Response(json.dumps(body), mimetype="application/json", headers=headers)
 
-# Returns all wildfires as JSON (latitude, longitude, description, reason).
+def _stream_list(db_name, table, fields):
+    args = request.args
+    where, params, limit, since_version = [], [], None, None
+    try:
+        if "bbox" in args:
+            clause, bbox_params = bbox_clause(table, *(float(v) for v in args["bbox"].split(",")))
+            where.append(clause)
+            params += bbox_params
+        if "since" in args:
+            where.append("t.updated_at >= ?")
+            params.append(_parse_since(args["since"]))
+        if "after_id" in args:
+            where.append("t.id > ?")
+            params.append(int(args["after_id"]))
+        if "limit" in args:
+            limit = int(args["limit"])
+            if not 0 < limit <= LIST_MAX_LIMIT:
+                raise ValueError
+        if "since_version" in args:
+            since_version = int(args["since_version"])
+            if where or limit or since_version < 0:
+                raise ValueError
+    except (TypeError, ValueError, OverflowError, OSError):   # fromtimestamp range errors
+        return jsonify({"error": "bbox=minlon,minlat,maxlon,maxlat, since=ISO-8601|epoch, "
+                                 f"integer after_id, limit in 1..{LIST_MAX_LIMIT}, "
+                                 "since_version >= 0 (not combined with other filters)"}), 400
+    ndjson = (args.get("format") == "ndjson"
+              or "application/x-ndjson" in request.headers.get("Accept", ""))
+
+    conn = get_db_connection(db_name)
+    # version is read before the rows: a concurrent write is re-sent, never lost
+    version = table_version(conn, table)
+    query = hashlib.sha1(request.query_string + request.headers.get("Accept", "").encode())
+    etag = f'W/"{table}-{version}-{query.hexdigest()[:12]}"'
+    headers = {"ETag": etag, "X-Change-Version": str(version), "Cache-Control": "no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        conn.close()
+        return Response(status=304, headers=headers)
+    if since_version is not None:
+        try:
+            return _list_delta(conn, table, fields, since_version, version, headers)
+        finally:
+            conn.close()
+
+    sql = (f"SELECT t.id AS cursor_id, {', '.join('t.' + f for f in fields)} FROM {table} t"
+           + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY t.id")
+    if limit:
+        # a page is bounded by LIST_MAX_LIMIT, so read it first to know the cursor
+        rows = conn.execute(sql + " LIMIT ?", (*params, limit)).fetchall()
+        conn.close()
+        if len(rows) == limit:
+            headers["X-Next-After-Id"] = str(rows[-1]["cursor_id"])
+        batches = iter([rows])
+    else:
+        cursor = conn.execute(sql, params)
+        batches = iter(lambda: cursor.fetchmany(LIST_FETCH_ROWS), [])
+
+    def generate():
+        try:
+            sep = "\n" if ndjson else ","
+            first = True
+            if not ndjson:
+                yield "["
+            for rows in batches:
+                if not rows:
+                    continue
+                chunk = sep.join(json.dumps({f: r[f] for f in fields}) for r in rows)
+                if ndjson:
+                    yield chunk + "\n"
+                else:
+                    yield chunk if first else "," + chunk
+                first = False
+            if not ndjson:
+                yield "]"
+        finally:
+            if not limit:
+                conn.close()
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(generate(), mimetype=mimetype, headers=headers)
+
+# Returns wildfires as JSON (latitude, longitude, description, reason).
 @api_bp.route("/api/get_fires", methods=["GET"])
 def get_fires():
-    conn = get_db_connection(WILDFIRE_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, latitude, longitude, description, reason FROM wildfires")
-    fires = cursor.fetchall()
-    conn.close()
-
-    fire_list = [
-        {
-            "id": row["id"],
-            "latitude": row["latitude"],
-            "longitude": row["longitude"],
-            "description": row["description"],
-            "reason": row["reason"]
-        }
-        for row in fires
-    ]
-    return jsonify(fire_list)
+    return _stream_list(WILDFIRE_DB, "wildfires",
+                        ["id", "latitude", "longitude", "description", "reason"])
 
 @api_bp.route("/api/fire_detail/<int:fire_id>")
 def fire_detail(fire_id: int):
@@ -99,9 +427,7 @@ def api_adaptive_mesh():
     d_lng =  half / (111.0 * math.cos(math.radians(lat)))
     bb = box(lng-d_lng, lat-d_lat, lng+d_lng, lat+d_lat)
 
-    mesh = _mesh_gdf()
-    clipped = mesh.loc[mesh.intersects(bb)]
-    return jsonify(clipped.__geo_interface__)
+    return Response(clip_layer_geojson("mesh", bb), mimetype="application/json")
 
 @api_bp.route("/api/road_graph")
 def api_road_graph():
@@ -116,13 +442,9 @@ def api_road_graph():
     d_lng = half / (111.0 * math.cos(math.radians(lat)))
     bb = box(lng - d_lng, lat - d_lat, lng + d_lng, lat + d_lat)
 
-    edges_clip = _graph_edges().loc[_graph_edges().intersects(bb)]
-    nodes_clip = _graph_nodes().loc[_graph_nodes().intersects(bb)]
-
-    return jsonify({
-        "edges": edges_clip.__geo_interface__,
-        "nodes": nodes_clip.__geo_interface__
-    })
+    body = ('{"edges":' + clip_layer_geojson("edges", bb)
+            + ',"nodes":' + clip_layer_geojson("nodes", bb) + "}")
+    return Response(body, mimetype="application/json")
 
 # ROAD CLOSURE ROUTES
 # Receives JSON with lat, lng, reason for a road closure, inserts into 'road_closures.db'.
@@ -135,6 +457,12 @@ def report_road_closure():
 
     if lat is None or lng is None:
         return jsonify({"error": "Latitude and Longitude are required."}), 400
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        lat = lng = math.nan
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):   # NaN fails too
+        return jsonify({"error": "Latitude and Longitude must be numbers in range."}), 400
 
     conn = get_db_connection(ROAD_CLOSURE_DB)
     cursor = conn.cursor()
@@ -143,32 +471,47 @@ def report_road_closure():
            VALUES (?, ?, ?)""",
         (lat, lng, reason)
     )
+    cid = cursor.lastrowid
     conn.commit()
     conn.close()
+    events.publish("road_closure", {"op": "added", "id": cid, "latitude": lat,
+                                    "longitude": lng, "reason": reason}, lat, lng)
+
+    # block the nearest road edge for routing
+    apply_road_closure(cid, lat, lng)
 
     return jsonify({"message": "Road closure reported successfully"}), 201
 
+# Bulk form of report_road_closure (see "Bulk ingestion" above)
+@api_bp.route("/api/report_road_closures", methods=["POST"])
+def report_road_closures():
+    parsed = _bulk_request(LAT_LNG_RANGES, {"reason": "Unknown"})
+    if not isinstance(parsed[0], pd.DataFrame):
+        return parsed
+    rows, errors, rejected = parsed
+    ids = _bulk_insert(ROAD_CLOSURE_DB, "road_closures", rows)
+    events.publish_many("road_closure", [
+        ({"op": "added", "id": cid, **r}, r["latitude"], r["longitude"])
+        for cid, r in zip(ids, rows.to_dict("records"))
+    ])
+
+    # block the nearest road edges, with one route cache flush for the batch
+    apply_road_closures(zip(ids, rows["latitude"].tolist(), rows["longitude"].tolist()))
+
+    return jsonify({
+        "message": f"{len(ids)} road closures reported",
+        "closure_ids": ids,
+        "rejected": rejected,
+        "errors": errors
+    }), 201
+
 @api_bp.route("/api/get_road_closures", methods=["GET"])
 def get_road_closures():
     """
-    Returns all road closures as JSON (latitude, longitude, reason).
+    Returns road closures as JSON (latitude, longitude, reason).
     """
-    conn = get_db_connection(ROAD_CLOSURE_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, latitude, longitude, reason FROM road_closures")
-    closures = cursor.fetchall()
-    conn.close()
-
-    closure_list = [
-        {
-            "id": row["id"],
-            "latitude": row["latitude"],
-            "longitude": row["longitude"],
-            "reason": row["reason"]
-        }
-        for row in closures
-    ]
-    return jsonify(closure_list)
+    return _stream_list(ROAD_CLOSURE_DB, "road_closures",
+                        ["id", "latitude", "longitude", "reason"])
 
 # USER LOCATION ROUTES
 @api_bp.route("/api/set_user_location", methods=["POST"])
@@ -201,36 +544,13 @@ def set_user_location():
 
 @api_bp.route("/api/get_user_locations", methods=["GET"])
 def get_user_locations():
-    conn = get_db_connection(USER_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT username, latitude, longitude FROM users")
-    users = cursor.fetchall()
-    conn.close()
-
-    user_list = [
-        {
-            "username": row["username"],
-            "latitude": row["latitude"],
-            "longitude": row["longitude"]
-        }
-        for row in users
-    ]
-    return jsonify(user_list)
+    return _stream_list(USER_DB, "users", ["id", "username", "latitude", "longitude"])
 
 # VEHICLE ROUTES & ALLOCATION
 @api_bp.route("/api/get_vehicles", methods=["GET"])
 def get_vehicles():
-    conn = get_db_connection(VEHICLE_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, latitude, longitude, capacity, vehicle_type FROM vehicles")
-    vehicles = cursor.fetchall()
-    conn.close()
-
-    vehicle_list = [
-        {"id": row["id"], "latitude": row["latitude"], "longitude": row["longitude"], "capacity": row["capacity"], "vehicle_type": row["vehicle_type"]}
-        for row in vehicles
-    ]
-    return jsonify(vehicle_list)
+    return _stream_list(VEHICLE_DB, "vehicles",
+                        ["id", "latitude", "longitude", "capacity", "vehicle_type"])
 
 
 @api_bp.route("/api/add_vehicle", methods=["POST"])
@@ -257,6 +577,25 @@ def add_vehicle():
     conn.close()
     return jsonify({"message": "Vehicle added successfully"}), 201
 
+# Bulk form of add_vehicle, e.g. a fleet roster CSV
+VEHICLE_MAX_CAPACITY = 1_000_000   # keeps capacities (and allocation sums) well inside int64
+
+@api_bp.route("/api/add_vehicles", methods=["POST"])
+def add_vehicles():
+    parsed = _bulk_request({**LAT_LNG_RANGES, "capacity": (1, VEHICLE_MAX_CAPACITY)},
+                           {"vehicle_type": "car"}, integer=("capacity",))
+    if not isinstance(parsed[0], pd.DataFrame):
+        return parsed
+    rows, errors, rejected = parsed
+    ids = _bulk_insert(VEHICLE_DB, "vehicles", rows)
+
+    return jsonify({
+        "message": f"{len(ids)} vehicles added",
+        "vehicle_ids": ids,
+        "rejected": rejected,
+        "errors": errors
+    }), 201
+
 
 @api_bp.route("/api/allocate_vehicles", methods=["POST"])
 def allocate_vehicles():
@@ -266,64 +605,10 @@ def allocate_vehicles():
     required_capacity = data.get("required_capacity", 10)  # default
     desired_type = data.get("vehicle_type")  # optional
 
-    conn = get_db_connection(VEHICLE_DB)
-    cursor = conn.cursor()
-
-    if desired_type:
-        cursor.execute(
-            """SELECT id, latitude, longitude, capacity, vehicle_type FROM vehicles WHERE vehicle_type = ?""",
-            (desired_type,)
-        )
-    else:
-        cursor.execute("SELECT id, latitude, longitude, capacity, vehicle_type FROM vehicles")
-
-    vehicles = cursor.fetchall()
-    conn.close()
-
-    # Sort by distance from the fire
-    vehicles_sorted = sorted(
-        vehicles,
-        key=lambda v: haversine_distance(fire_lat, fire_lng, v["latitude"], v["longitude"])
+    result = allocate_nearest_vehicles(
+        fire_lat, fire_lng, required_capacity, vehicle_type=desired_type
     )
-
-    allocated_vehicles = []
-    total_capacity_overall = 0
-
-    for v in vehicles_sorted:
-        vid = v["id"]
-        vlat = v["latitude"]
-        vlng = v["longitude"]
-        vcap = v["capacity"]
-        vtype = v["vehicle_type"]
-
-        dist_km = haversine_distance(fire_lat, fire_lng, vlat, vlng)
-        # If within 50km and we still need more capacity
-        if dist_km <= 50 and total_capacity_overall < required_capacity:
-            allocated_vehicles.append({
-                "id": vid,
-                "latitude": vlat,
-                "longitude": vlng,
-                "capacity": vcap,
-                "vehicle_type": vtype
-            })
-            total_capacity_overall += vcap
-            if total_capacity_overall >= required_capacity:
-                break
-
-    # Summarize by vehicle type
-    type_summary = {}
-    for veh in allocated_vehicles:
-        vt = veh["vehicle_type"]
-        if vt not in type_summary:
-            type_summary[vt] = {"count": 0, "total_capacity": 0}
-        type_summary[vt]["count"] += 1
-        type_summary[vt]["total_capacity"] += veh["capacity"]
-
-    return jsonify({
-        "allocated_vehicles": allocated_vehicles,
-        "total_capacity_overall": total_capacity_overall,
-        "type_summary": type_summary
-    }), 200
+    return jsonify(result), 200
 
 @api_bp.route("/api/route_plan")
 def api_route_plan():
@@ -335,16 +620,16 @@ def api_route_plan():
     s = _nearest_node(lat1, lng1)
     t = _nearest_node(lat2, lng2)
 
-    # Dijkstra
-    try:
-        path = nx.shortest_path(G_ROUTE, s, t, weight="weight")
-    except nx.NetworkXNoPath:
+    # A* on the CSR graph; ?engine=nx forces the networkx Dijkstra
+    found = shortest_route(s, t, engine=request.args.get("engine", "astar"))
+    if found is None:
         return {"error": "no path"}, 404
+    path, dist_m = found
 
     '''
     coords = []
     for u, v in zip(path[:-1], path[1:]):
-        geom = G_ROUTE.edges[u, v]['geometry']
+        geom = _graph_edges().geometry.iloc[G_ROUTE.edges[u, v]['row']]
         coords.extend(list(geom.coords))
 
     unique = [coords[0]] + [c for i, c in enumerate(coords[1:]) if c != coords[i]]
@@ -352,12 +637,10 @@ def api_route_plan():
 
     return {"route": line.__geo_interface__}
     '''
-    pts = [G_ROUTE.nodes[nid]['pos'] for nid in path]
-    lonlat = [(p[1], p[0]) for p in pts]                  #  turn to (lon,lat)
+    lonlat = path_lonlat(path)                            #  (lon,lat) per node
+    if len(lonlat) == 1:
+        lonlat.append(lonlat[0])                          # same node: zero-length line
     line = LineString(lonlat)
-    dist_m = 0.0
-    for u, v in zip(path[:-1], path[1:]):
-        dist_m += G_ROUTE.edges[u, v]["weight"]                # weight (m)
     dist_km = round(dist_m / 1000.0, 2)                        # two decimal
 
     return {
@@ -365,3 +648,70 @@ def api_route_plan():
         "distance_km": dist_km
     }
 
+# Many-to-many road distances.
+# Body: {"sources": [[lat, lng], ...], "targets": [[lat, lng], ...],
+#        "max_snap_m": optional}. Points that don't snap to the network get
+# null rows/columns; unreachable pairs are null.
+ROUTE_MATRIX_MAX_POINTS = 5000
+
+@api_bp.route("/api/route_matrix", methods=["POST"])
+def api_route_matrix():
+    data = request.get_json(silent=True) or {}
+    try:
+        src = np.asarray(data["sources"], dtype=float).reshape(-1, 2)
+        tgt = np.asarray(data["targets"], dtype=float).reshape(-1, 2)
+        max_snap_m = float(data.get("max_snap_m", MAX_SNAP_M))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "sources and targets must be [[lat, lng], ...]"}), 400
+    if not len(src) or not len(tgt):
+        return jsonify({"error": "sources and targets must be non-empty"}), 400
+    if max(len(src), len(tgt)) > ROUTE_MATRIX_MAX_POINTS:
+        return jsonify({"error": f"at most {ROUTE_MATRIX_MAX_POINTS} sources/targets"}), 413
+
+    src_ids, src_snap = snap_points(src[:, 0], src[:, 1], max_snap_m)
+    tgt_ids, tgt_snap = snap_points(tgt[:, 0], tgt[:, 1], max_snap_m)
+    src_ok, tgt_ok = src_ids >= 0, tgt_ids >= 0
+
+    dist = np.full((len(src), len(tgt)), np.nan)
+    if src_ok.any() and tgt_ok.any():
+        dist[np.ix_(src_ok, tgt_ok)] = route_matrix(src_ids[src_ok].tolist(),
+                                                    tgt_ids[tgt_ok].tolist())
+    km = np.round(dist / 1000.0, 3).astype(object)
+    km[np.isnan(dist)] = None
+
+    def _snapped(ids, snap):
+        return [{"node": int(n), "snap_m": round(float(d), 1)} if n >= 0 else None
+                for n, d in zip(ids, snap)]
+
+    return jsonify({
+        "distance_km": km.tolist(),
+        "sources": _snapped(src_ids, src_snap),
+        "targets": _snapped(tgt_ids, tgt_snap)
+    })
+
+# Reachability from a point: ?lat=&lng=&km= (road distance) or
+# ?lat=&lng=&minutes=[&speed_kmh=] (travel time at a flat speed)
+ISOCHRONE_SPEED_KMH = 40.0
+ISOCHRONE_MAX_KM = 200.0
+
+@api_bp.route("/api/isochrone")
+def api_isochrone():
+    try:
+        lat = float(request.args["lat"])
+        lng = float(request.args["lng"])
+        if "minutes" in request.args:
+            speed = float(request.args.get("speed_kmh", ISOCHRONE_SPEED_KMH))
+            budget_km = float(request.args["minutes"]) / 60.0 * speed
+        else:
+            budget_km = float(request.args["km"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat,lng and km or minutes query params required"}), 400
+    if not 0 < budget_km <= ISOCHRONE_MAX_KM:
+        return jsonify({"error": f"budget must be within (0, {ISOCHRONE_MAX_KM}] km"}), 400
+
+    result = isochrone(_nearest_node(lat, lng), budget_km * 1000.0)
+    return jsonify({"budget_km": round(budget_km, 3), **result})
+
+@api_bp.route("/api/route_cache_stats")
+def api_route_cache_stats():
+    return jsonify(ROUTE_CACHE.stats())
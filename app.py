@@ -9,6 +9,10 @@ app.secret_key = "supersecretkey"
 CORS(app)
 app.register_blueprint(api_bp)
 
+# Create missing tables / indexes here rather than under __main__, so the
+# schema is also in place under `flask run` or a WSGI server
+init_db()
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     # If user is already logged in, redirect to map
@@ -72,5 +76,4 @@ def logout():
     return redirect(url_for("login"))  # show the login page
 
 if __name__ == "__main__":
-    init_db()  # Ensure tables exist before running
     app.run(debug=True)
\ No newline at end of file
@@ -1,14 +1,21 @@
 # core.py – shared utilities: DB helpers, GeoPandas caches, routing graph
+import gzip
+import hashlib
+import json
 import math
 import os
 import sqlite3
+import threading
+import time
 import geopandas as gpd
 import numpy as np
 import networkx as nx
+import pandas as pd
+import shapely
 
 from pathlib import Path
 from scipy.spatial import cKDTree
-from fire import get_fire_layers_geojson
+import fire
 from functools import lru_cache
 
 # File paths / constants
@@ -22,16 +29,116 @@ WILDFIRE_DB = "data/wildfires.db"
 ROAD_CLOSURE_DB = "data/road_closures.db"
 USER_DB = "data/user.db"
 VEHICLE_DB = "data/vehicles.db"
+JOBS_DB = "data/jobs.db"  # background job queue (jobs.py)
 
 # Change this for security
 GOVERNMENT_USERS = {"admin": "password123"}
 
+# SQLite connection pool. get_db_connection() hands out a pooled connection
+# (WAL mode, tuned pragmas, prepared-statement cache); conn.close() returns it
+# to its database's pool instead of closing it, rolling back anything left
+# uncommitted, exactly like a real close would have discarded it.
+DB_POOL_IDLE = 8              # idle connections kept per database file
+DB_STATEMENT_CACHE = 256      # prepared statements cached per connection
+DB_BUSY_TIMEOUT_MS = 5000
+DB_SLOW_QUERY_MS = 200        # statements slower than this are printed
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+)
+
+_db_pools = {}                # db_name -> idle connections (LIFO)
+_db_pool_pid = os.getpid()    # a forked worker must not reuse the parent's sockets/files
+_db_pool_lock = threading.Lock()
+_db_stats = {}                # (db_name, sql) -> [count, total_ms, max_ms]
+_db_stats_lock = threading.Lock()
+
+def _record_query(db_name, sql, t0):
+    ms = (time.perf_counter() - t0) * 1000
+    key = (db_name, " ".join(sql.split()))
+    with _db_stats_lock:
+        st = _db_stats.setdefault(key, [0, 0.0, 0.0])
+        st[0] += 1
+        st[1] += ms
+        st[2] = max(st[2], ms)
+    if ms >= DB_SLOW_QUERY_MS:
+        print(f"[db] slow query {ms:.0f} ms on {db_name}: {key[1][:200]}")
+
+class _TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _record_query(self.connection.db_name, sql, t0)
+
+    def executemany(self, sql, seq):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            _record_query(self.connection.db_name, sql, t0)
+
+class PooledConnection(sqlite3.Connection):
+    db_name = None
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        self.row_factory = sqlite3.Row
+        with _db_pool_lock:
+            idle = _db_pools.setdefault(self.db_name, [])
+            if os.getpid() == _db_pool_pid and len(idle) < DB_POOL_IDLE:
+                idle.append(self)
+                return
+        super().close()
+
+def _open_db(db_name):
+    conn = sqlite3.connect(db_name, factory=PooledConnection, check_same_thread=False,
+                           cached_statements=DB_STATEMENT_CACHE,
+                           timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    conn.db_name = db_name
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
 # Helper function for database connection
 def get_db_connection(db_name):
-    conn = sqlite3.connect(db_name)
+    global _db_pool_pid
+    with _db_pool_lock:
+        if os.getpid() != _db_pool_pid:
+            _db_pools.clear()
+            _db_pool_pid = os.getpid()
+        idle = _db_pools.get(db_name)
+        conn = idle.pop() if idle else None
+    if conn is None:
+        conn = _open_db(db_name)
     conn.row_factory = sqlite3.Row
     return conn
 
+def db_stats():
+    """Per-statement timings since start-up, slowest total first."""
+    with _db_stats_lock:
+        rows = [{"db": db, "sql": sql, "count": c, "total_ms": round(t, 3),
+                 "avg_ms": round(t / c, 3), "max_ms": round(m, 3)}
+                for (db, sql), (c, t, m) in _db_stats.items()]
+    with _db_pool_lock:
+        idle = {db: len(conns) for db, conns in _db_pools.items()}
+    return {"queries": sorted(rows, key=lambda r: -r["total_ms"]), "idle_connections": idle}
+
 # Initialize database tables if they do not exist
 def init_db():
     db_table_queries = [
@@ -91,10 +198,63 @@ def init_db():
             conn.commit()
             conn.close()
 
-# Fire overlay cache
-@lru_cache(maxsize=1)
+    # R*Tree indexes / updated_at are also added to databases created before they existed
+    for table in SPATIAL_TABLES:
+        init_spatial_index(table)
+        init_updated_at(table)
+        init_change_log(table)
+
+# Fire overlay cache: serialised and gzipped once, with a strong ETag.
+# The buildings and fires JSON parts are kept separately so newly ingested
+# fires are spliced onto the fires array instead of re-serialising everything.
+# The number of fire rows serialised is kept too: appended rows arrive indexed
+# by their position in fire_df, and rows a concurrent first build already read
+# are not spliced in a second time.
+_fire_layers = None           # (buildings_json, fires_json, fire rows, gzip bytes, etag)
+_fire_layers_lock = threading.Lock()
+
+def _pack_fire_layers(buildings_json, fires_json, n_fires):
+    body = ('{"buildings":' + buildings_json + ',"fires":' + fires_json + "}").encode()
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return buildings_json, fires_json, n_fires, gzip.compress(body, compresslevel=6), etag
+
 def _fire_layers_cached():
-    return get_fire_layers_geojson()
+    global _fire_layers
+    with _fire_layers_lock:
+        if _fire_layers is None:
+            fire_df = fire.get_fire_df()
+            _fire_layers = _pack_fire_layers(
+                fire.get_bldg_gdf().to_crs(epsg=4326).to_json(),
+                json.dumps(fire.get_fire_records(df=fire_df)), len(fire_df))
+        return _fire_layers[3], _fire_layers[4]
+
+@fire.on_fires_appended
+def _append_fire_layers(new_rows):
+    global _fire_layers
+    with _fire_layers_lock:
+        if _fire_layers is None:
+            return
+        buildings_json, fires_json, n_fires = _fire_layers[:3]
+        new_rows = new_rows[new_rows.index >= n_fires]
+        if new_rows.empty:
+            return
+        if new_rows.index[0] != n_fires:      # an earlier batch has not arrived: rebuild
+            _fire_layers = None
+            return
+        added = json.dumps(fire.get_fire_records(df=new_rows))
+        if fires_json != "[]":
+            added = fires_json[:-1] + ", " + added[1:]
+        _fire_layers = _pack_fire_layers(buildings_json, added, int(new_rows.index[-1]) + 1)
+
+def _buildings_gdf():
+    return fire.get_bldg_gdf()
+
+# Fire points (same records as the overlay) inside a lon/lat box
+def fire_records_in_bbox(min_lng, min_lat, max_lng, max_lat):
+    df = fire.get_fire_df()
+    mask = (df["longitude"].between(min_lng, max_lng)
+            & df["latitude"].between(min_lat, max_lat))
+    return fire.get_fire_records(mask.to_numpy())
 
 # Simple geodesic distance
 def haversine_distance(lat1, lon1, lat2, lon2):
@@ -108,6 +268,233 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return R * c
 
+# Vectorised haversine: scalar origin against arrays of lat/lon (km)
+def haversine_np(lat1, lon1, lats, lons):
+    R = 6371.0
+    lat1, lon1 = np.radians(lat1), np.radians(lon1)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (np.sin((lats - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lats) * np.sin((lons - lon1) / 2) ** 2)
+    return 2 * R * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+# Spatial index
+# Every located table has an R*Tree shadow table kept in sync by triggers, so
+# bbox/radius questions are answered inside SQLite instead of by full scans.
+# R*Tree boxes are 32-bit floats rounded outward, so hits are re-checked
+# against the exact latitude/longitude columns of the joined base row.
+SPATIAL_TABLES = {
+    "wildfires": WILDFIRE_DB,
+    "road_closures": ROAD_CLOSURE_DB,
+    "users": USER_DB,
+    "vehicles": VEHICLE_DB,
+}
+KM_PER_DEG = 111.0            # just under haversine's 111.19 km, so boxes never clip the circle
+
+# Create the R*Tree + triggers (idempotent) and backfill existing rows once
+def init_spatial_index(table):
+    rt = f"{table}_rtree"
+    conn = get_db_connection(SPATIAL_TABLES[table])
+    fresh = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (rt,)
+    ).fetchone() is None
+    conn.executescript(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {rt}
+            USING rtree(id, min_lat, max_lat, min_lng, max_lng);
+        CREATE TRIGGER IF NOT EXISTS {rt}_ins AFTER INSERT ON {table}
+        WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL BEGIN
+            DELETE FROM {rt} WHERE id = NEW.id;
+            INSERT INTO {rt}
+            VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END;
+        CREATE TRIGGER IF NOT EXISTS {rt}_upd AFTER UPDATE OF id, latitude, longitude ON {table}
+        BEGIN
+            DELETE FROM {rt} WHERE id = OLD.id;
+            DELETE FROM {rt} WHERE id = NEW.id;
+            INSERT INTO {rt}
+            SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+        END;
+        CREATE TRIGGER IF NOT EXISTS {rt}_del AFTER DELETE ON {table} BEGIN
+            DELETE FROM {rt} WHERE id = OLD.id;
+        END;
+    """)
+    if fresh:
+        conn.execute(
+            f"INSERT OR REPLACE INTO {rt} SELECT id, latitude, latitude, longitude, longitude "
+            f"FROM {table} WHERE latitude IS NOT NULL AND longitude IS NOT NULL")
+        conn.commit()
+    conn.close()
+
+# Row modification time (UTC ISO-8601, sortable as text) maintained by
+# triggers, for ?since= filtering. SQLite cannot ALTER TABLE ADD COLUMN with a
+# non-constant default, so inserts are stamped by an AFTER INSERT trigger;
+# rows that predate the column get the migration time.
+UTC_NOW_SQL = "strftime('%Y-%m-%dT%H:%M:%fZ', 'now')"
+
+def init_updated_at(table):
+    conn = get_db_connection(SPATIAL_TABLES[table])
+    conn.execute("BEGIN IMMEDIATE")       # workers starting together add the column once
+    cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+    if "updated_at" not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN updated_at TEXT")
+        conn.execute(f"UPDATE {table} SET updated_at = {UTC_NOW_SQL}")
+    conn.commit()
+    conn.executescript(f"""
+        CREATE INDEX IF NOT EXISTS {table}_updated_at ON {table} (updated_at);
+        CREATE TRIGGER IF NOT EXISTS {table}_stamp_ins AFTER INSERT ON {table}
+        WHEN NEW.updated_at IS NULL BEGIN
+            UPDATE {table} SET updated_at = {UTC_NOW_SQL} WHERE id = NEW.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS {table}_stamp_upd AFTER UPDATE ON {table}
+        WHEN NEW.updated_at IS OLD.updated_at BEGIN
+            UPDATE {table} SET updated_at = {UTC_NOW_SQL} WHERE id = NEW.id;
+        END;
+    """)
+    conn.close()
+
+# Change log: one entry per row, re-numbered on every insert/update/delete,
+# so a table's version is MAX(version) and "what changed since v" is a range
+# scan. Deleted rows leave a tombstone entry (op = 'delete').
+# Triggers delete-then-insert rather than INSERT OR REPLACE: an outer UPSERT's
+# conflict policy would override the trigger's OR REPLACE.
+def init_change_log(table):
+    log = f"{table}_changes"
+    conn = get_db_connection(SPATIAL_TABLES[table])
+    conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS {log} (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            row_id INTEGER NOT NULL UNIQUE,
+            op TEXT NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS {log}_ins AFTER INSERT ON {table} BEGIN
+            DELETE FROM {log} WHERE row_id = NEW.id;
+            INSERT INTO {log} (row_id, op) VALUES (NEW.id, 'upsert');
+        END;
+        CREATE TRIGGER IF NOT EXISTS {log}_upd AFTER UPDATE ON {table} BEGIN
+            DELETE FROM {log} WHERE row_id = NEW.id;
+            INSERT INTO {log} (row_id, op) VALUES (NEW.id, 'upsert');
+        END;
+        CREATE TRIGGER IF NOT EXISTS {log}_del AFTER DELETE ON {table} BEGIN
+            DELETE FROM {log} WHERE row_id = OLD.id;
+            INSERT INTO {log} (row_id, op) VALUES (OLD.id, 'delete');
+        END;
+    """)
+    conn.close()
+
+def table_version(conn, table):
+    return conn.execute(f"SELECT IFNULL(MAX(version), 0) FROM {table}_changes").fetchone()[0]
+
+# Rows changed after `version`: (upserted rows, deleted ids, new version)
+def changes_since(conn, table, version, columns):
+    rows = conn.execute(
+        f"SELECT c.version AS change_version, c.op AS change_op, c.row_id AS change_row, {columns} "
+        f"FROM {table}_changes c LEFT JOIN {table} t ON t.id = c.row_id "
+        "WHERE c.version > ? ORDER BY c.version", (version,)
+    ).fetchall()
+    upserts = [r for r in rows if r["change_op"] == "upsert"]
+    deletes = [r["change_row"] for r in rows if r["change_op"] == "delete"]
+    return upserts, deletes, rows[-1]["change_version"] if rows else version
+
+# Lon/lat boxes covering a circle; split in two across the antimeridian
+def _radius_boxes(lat, lng, radius_km):
+    d_lat = radius_km / KM_PER_DEG
+    lat0, lat1 = max(lat - d_lat, -90.0), min(lat + d_lat, 90.0)
+    cos_lat = math.cos(math.radians(min(abs(lat) + d_lat, 90.0)))
+    d_lng = 180.0 if cos_lat < 1e-6 else min(radius_km / (KM_PER_DEG * cos_lat), 180.0)
+    if d_lng >= 180.0:
+        return [(-180.0, lat0, 180.0, lat1)]
+    lng0, lng1 = lng - d_lng, lng + d_lng
+    if lng0 < -180.0:
+        return [(lng0 + 360.0, lat0, 180.0, lat1), (-180.0, lat0, lng1, lat1)]
+    if lng1 > 180.0:
+        return [(lng0, lat0, 180.0, lat1), (-180.0, lat0, lng1 - 360.0, lat1)]
+    return [(lng0, lat0, lng1, lat1)]
+
+# Rows of `table` inside lon/lat boxes (R*Tree lookup + exact re-check)
+def rows_in_bbox(table, min_lng, min_lat, max_lng, max_lat, columns="t.*",
+                 where="", params=()):
+    return _rows_in_boxes(table, [(min_lng, min_lat, max_lng, max_lat)], columns, where, params)
+
+# WHERE fragment (and params) selecting rows of `table` alias t inside a box;
+# min_lng > max_lng means the box crosses the antimeridian
+def bbox_clause(table, min_lng, min_lat, max_lng, max_lat):
+    if min_lng > max_lng:
+        east, east_params = bbox_clause(table, min_lng, min_lat, 180.0, max_lat)
+        west, west_params = bbox_clause(table, -180.0, min_lat, max_lng, max_lat)
+        return f"(({east}) OR ({west}))", east_params + west_params
+    sql = (f"t.id IN (SELECT id FROM {table}_rtree WHERE max_lat >= ? AND min_lat <= ? "
+           "AND max_lng >= ? AND min_lng <= ?) "
+           "AND t.latitude BETWEEN ? AND ? AND t.longitude BETWEEN ? AND ?")
+    return sql, [min_lat, max_lat, min_lng, max_lng] * 2
+
+def _rows_in_boxes(table, boxes, columns="t.*", where="", params=()):
+    conn = get_db_connection(SPATIAL_TABLES[table])
+    rows = []
+    for box in boxes:                              # boxes never overlap
+        clause, args = bbox_clause(table, *box)
+        sql = (f"SELECT {columns} FROM {table} t WHERE {clause}"
+               + (f" AND ({where})" if where else "") + " ORDER BY t.id")
+        rows += conn.execute(sql, (*args, *params)).fetchall()
+    conn.close()
+    return rows
+
+# Rows within radius_km of (lat, lng) as (rows, distances km), nearest first
+def rows_within_radius(table, lat, lng, radius_km, columns="t.*", where="", params=()):
+    cols = columns if columns == "t.*" else f"{columns}, t.latitude, t.longitude"
+    rows = _rows_in_boxes(table, _radius_boxes(lat, lng, radius_km), cols, where, params)
+    if not rows:
+        return [], np.empty(0)
+    dist = haversine_np(lat, lng, np.array([r["latitude"] for r in rows], dtype=float),
+                        np.array([r["longitude"] for r in rows], dtype=float))
+    hit = np.flatnonzero(dist <= radius_km)
+    hit = hit[np.argsort(dist[hit], kind="stable")]
+    return [rows[i] for i in hit], dist[hit]
+
+# Batch form of rows_within_radius for many points: one R*Tree query over
+# the points' combined box, then a KD-tree on unit vectors pairs rows with
+# points. Returns (rows, [(row indices, km) per point, nearest first]).
+def rows_near_points(table, lats, lngs, radius_km, columns="t.*", where="", params=()):
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    if not len(lats):
+        return [], []
+    d_lat = radius_km / KM_PER_DEG
+    cos_lat = np.cos(np.radians(np.minimum(np.abs(lats) + d_lat, 90.0)))
+    d_lng = radius_km / (KM_PER_DEG * np.maximum(cos_lat, 1e-9))
+    lng0, lng1 = lngs - d_lng, lngs + d_lng
+    if lng0.min() < -180.0 or lng1.max() > 180.0:
+        lng0, lng1 = np.array([-180.0]), np.array([180.0])   # wraps: every longitude
+    box = (float(lng0.min()), max(float(lats.min()) - d_lat, -90.0),
+           float(lng1.max()), min(float(lats.max()) + d_lat, 90.0))
+
+    cols = columns if columns == "t.*" else f"{columns}, t.latitude, t.longitude"
+    rows = _rows_in_boxes(table, [box], cols, where, params)
+    empty = (np.empty(0, dtype=np.int64), np.empty(0))
+    if not rows:
+        return [], [empty] * len(lats)
+
+    def _xyz(la, ln):
+        la, ln = np.radians(la), np.radians(ln)
+        return np.column_stack([np.cos(la) * np.cos(ln), np.cos(la) * np.sin(ln), np.sin(la)])
+
+    r_lat = np.array([r["latitude"] for r in rows], dtype=float)
+    r_lng = np.array([r["longitude"] for r in rows], dtype=float)
+    chord = 2 * math.sin(min(radius_km / 6371.0, math.pi) / 2) * (1 + 1e-9)
+    hits = cKDTree(_xyz(r_lat, r_lng)).query_ball_point(_xyz(lats, lngs), chord)
+    out = []
+    for k, idx in enumerate(hits):
+        idx = np.asarray(idx, dtype=np.int64)
+        dist = haversine_np(lats[k], lngs[k], r_lat[idx], r_lng[idx])
+        keep = dist <= radius_km
+        order = np.lexsort((idx[keep], dist[keep]))   # nearest first, ties by row order
+        out.append((idx[keep][order], dist[keep][order]))
+    return rows, out
+
+# Usernames within radius_km of (lat, lng), nearest first
+def users_within_radius(lat, lng, radius_km):
+    rows, _ = rows_within_radius("users", lat, lng, radius_km, "t.username")
+    return [r["username"] for r in rows]
+
 # GeoPandas cached layers
 @lru_cache(maxsize=1)
 def _mesh_gdf():
@@ -121,54 +508,214 @@ def _graph_edges():
 def _graph_nodes():
     return gpd.read_file(NODES_FILE).to_crs(epsg=4326)
 
-# Routing graph (NetworkX + KD‑Tree)
-G_ROUTE = nx.Graph()          # global graph instance
+# Spatial index + pre-serialised GeoJSON features per layer
+# Each feature is dumped once; a bbox clip is an STRtree query plus a
+# string join, with no __geo_interface__ rebuild or jsonify per request.
+_LAYERS = {"mesh": _mesh_gdf, "edges": _graph_edges, "nodes": _graph_nodes,
+           "buildings": _buildings_gdf}
+
+@lru_cache(maxsize=None)
+def _layer_fragments(name):
+    gdf = _LAYERS[name]()
+    features = json.loads(gdf.to_json(drop_id=False))["features"]
+    frags = [json.dumps(f, separators=(",", ":")) for f in features]
+    return gdf.sindex, frags
+
+# FeatureCollection JSON text of the layer's features intersecting geom;
+# keep (optional boolean array over the layer's rows) filters further.
+def clip_layer_geojson(name, geom, keep=None):
+    sindex, frags = _layer_fragments(name)
+    idx = np.sort(sindex.query(geom, predicate="intersects"))
+    if keep is not None:
+        idx = idx[keep[idx]]
+    return ('{"type":"FeatureCollection","features":['
+            + ",".join([frags[i] for i in idx]) + "]}")
+
+# Routing graph (NumPy arrays + KD‑Tree, NetworkX view on demand)
+ROUTE_CACHE_DIR = Path("outputs/cache")
+ROUTE_CACHE_VERSION = 1       # bump when the compiled layout/semantics change
+
+G_ROUTE = nx.Graph()          # networkx view, filled by _ensure_nx_graph()
 KD_IDX  = None                # KD‑Tree for nearest‑node lookup
+KD_NODE_IDS = None            # KD‑Tree row -> graph node id
+MAX_SNAP_M = 2000.0           # default cutoff for snap_points (metres)
+
+NODE_LATLNG = None            # (N, 2) lat,lon per node id
+EDGE_UV = None                # (E, 2) node ids of each undirected edge
+EDGE_W = None                 # (E,)  effective weight in metres (closures applied)
+EDGE_W_BASE = None            # (E,)  edge length in metres as compiled
+EDGE_ROW = None               # (E,)  source row in EDGES_FILE (for geometry)
+CSR_INDPTR = None             # (N+1,) adjacency offsets per node
+CSR_INDICES = None            # (2E,) neighbour node id per slot
+CSR_EDGE = None               # (2E,) undirected edge index per slot
+EDGE_SLOTS = None             # (E, 2) the two CSR slots of each edge
+
+GRAPH_BUILD = 0               # bumped when the arrays are (re)loaded
+GRAPH_VERSION = 0             # bumped on any routing-relevant change
+
+# Call after changing edge weights so cached routes are dropped
+def bump_graph_version():
+    global GRAPH_VERSION
+    GRAPH_VERSION += 1
+    return GRAPH_VERSION
+
+def _file_sha1(path, bufsize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(bufsize), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# SHA-1 of EDGES_FILE, re-hashed only when its size/mtime changed since the
+# last start (the stamp sits next to the compiled cache)
+def _edges_sha1():
+    st = os.stat(EDGES_FILE)
+    stamp = {"path": str(Path(EDGES_FILE).resolve()), "size": st.st_size,
+             "mtime_ns": st.st_mtime_ns}
+    stamp_file = ROUTE_CACHE_DIR / "route_graph_source.json"
+    try:
+        known = json.loads(stamp_file.read_text())
+        if {k: known.get(k) for k in stamp} == stamp:
+            return known["sha1"]
+    except (OSError, ValueError, KeyError):
+        pass
+    stamp["sha1"] = _file_sha1(EDGES_FILE)
+    ROUTE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = stamp_file.with_name(f"{stamp_file.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(stamp))
+    os.replace(tmp, stamp_file)
+    return stamp["sha1"]
+
+def _route_cache_path(src_hash):
+    return ROUTE_CACHE_DIR / f"route_graph_v{ROUTE_CACHE_VERSION}_{src_hash[:16]}.npz"
+
+# Compile EDGES_FILE into node/edge/CSR arrays (vectorised, no iterrows)
+def _compile_route_graph():
+    edges = _graph_edges()
+    edges = edges[~(edges.geometry.isna() | edges.geometry.is_empty)]
+
+    # first/last vertex of every line in one pass
+    coords, gi = shapely.get_coordinates(edges.geometry.values, return_index=True)
+    counts = np.bincount(gi, minlength=len(edges))
+    last = np.cumsum(counts) - 1
+    first = last - counts + 1
+    ends = np.round(np.concatenate([coords[first], coords[last]]), 6)  # lon,lat
+
+    # round lon/lat to 6 digits (≈11 cm) so duplicates collapse
+    uniq, inv = np.unique(ends, axis=0, return_inverse=True)
+    inv = inv.ravel()
+    n_edges = len(edges)
+    u, v = inv[:n_edges], inv[n_edges:]
+
+    # metres: prefer the source "length" column, else measure in local UTM
+    length = edges.to_crs(edges.estimate_utm_crs()).length.to_numpy()
+    if "length" in edges.columns:
+        given = pd.to_numeric(edges["length"], errors="coerce").to_numpy(dtype=float)
+        length = np.where(np.isnan(given), length, given)
+    rows = np.arange(n_edges)
+
+    # drop self-loops; keep the shortest of any parallel edges
+    keep = u != v
+    a, b = np.minimum(u, v)[keep], np.maximum(u, v)[keep]
+    length, rows = length[keep], rows[keep]
+    order = np.lexsort((length, b, a))
+    a, b, length, rows = a[order], b[order], length[order], rows[order]
+    first_of_pair = np.ones(len(a), dtype=bool)
+    first_of_pair[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+    edge_uv = np.column_stack([a, b])[first_of_pair]
+
+    return {
+        "node_latlng": uniq[:, ::-1].copy(),
+        "edge_uv": edge_uv.astype(np.int64),
+        "edge_w": length[first_of_pair].astype(float),
+        "edge_row": rows[first_of_pair].astype(np.int64),
+    }
+
+# Directed CSR adjacency over the undirected edge list
+def _build_csr(n_nodes, edge_uv):
+    n_edges = len(edge_uv)
+    src = np.concatenate([edge_uv[:, 0], edge_uv[:, 1]])
+    dst = np.concatenate([edge_uv[:, 1], edge_uv[:, 0]])
+    eid = np.concatenate([np.arange(n_edges), np.arange(n_edges)])
+    order = np.argsort(src, kind="stable")
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n_nodes), out=indptr[1:])
+    return indptr, dst[order].astype(np.int64), eid[order].astype(np.int64)
+
+def _load_or_compile_route_graph():
+    src_hash = _edges_sha1()
+    cache = _route_cache_path(src_hash)
+    if cache.exists():
+        try:
+            with np.load(cache) as z:
+                if (int(z["version"]) == ROUTE_CACHE_VERSION
+                        and str(z["source_sha1"]) == src_hash):
+                    return {k: z[k] for k in z.files}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"route graph cache {cache} unreadable ({e}), rebuilding")
+
+    g = _compile_route_graph()
+    g["csr_indptr"], g["csr_indices"], g["csr_edge"] = _build_csr(
+        len(g["node_latlng"]), g["edge_uv"])
+    g["version"] = np.array(ROUTE_CACHE_VERSION)
+    g["source_sha1"] = np.array(src_hash)
+
+    ROUTE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_name(f"{cache.stem}.{os.getpid()}.tmp.npz")
+    np.savez(tmp, **g)
+    os.replace(tmp, cache)
+    return g
 
 # Build graph the first time any route query is made
 def _init_route_graph():
-    global G_ROUTE, KD_IDX, _nodes_latlng
-
-    edges = _graph_edges().to_crs(epsg=4326)   # lon/lat
+    global KD_IDX, KD_NODE_IDS, NODE_LATLNG, EDGE_UV, EDGE_W, EDGE_W_BASE, EDGE_ROW
+    global CSR_INDPTR, CSR_INDICES, CSR_EDGE, EDGE_SLOTS, GRAPH_BUILD
 
+    g = _load_or_compile_route_graph()
+    NODE_LATLNG = g["node_latlng"]
+    EDGE_UV, EDGE_ROW = g["edge_uv"], g["edge_row"]
+    EDGE_W_BASE, EDGE_W = g["edge_w"], g["edge_w"].copy()
+    CSR_INDPTR, CSR_INDICES, CSR_EDGE = g["csr_indptr"], g["csr_indices"], g["csr_edge"]
+    EDGE_SLOTS = np.argsort(CSR_EDGE, kind="stable").reshape(-1, 2)
     G_ROUTE.clear()
-    nodes_seen = {}          # (lon,lat) to id
-    
-    def _key(coord, ndigits=6):
-    # round lon/lat to 6 digits (≈11 cm) so duplicates collapse
-        return (round(coord[0], ndigits), round(coord[1], ndigits))
-
-    def _get_node_id(coord):
-        k = _key(coord)
-        if k in nodes_seen:
-            return nodes_seen[k]
-        nid = len(nodes_seen)
-        nodes_seen[k] = nid
-        G_ROUTE.add_node(nid, pos=(coord[1], coord[0]))
-        return nid
-
-    # add edges
-    for _, row in edges.iterrows():
-        geom = row.geometry
-        lon1, lat1 = geom.coords[0]
-        lon2, lat2 = geom.coords[-1]
-
-        u = _get_node_id((lon1, lat1))
-        v = _get_node_id((lon2, lat2))
-
-        # weight in metres: prefer existing column else fallback to geom length
-        dist = row.get("length", geom.length * 111_139)
-        G_ROUTE.add_edge(u, v, weight=float(dist), geometry=geom)
 
     # build KD‑Tree for nearest‑node lookup
-    _nodes_latlng = np.array([[d[1], d[0]] for d in nodes_seen])  # lat,lon
-    KD_IDX = cKDTree(_nodes_latlng)
+    KD_NODE_IDS = np.arange(len(NODE_LATLNG), dtype=np.int64)
+    KD_IDX = cKDTree(NODE_LATLNG)
+    GRAPH_BUILD += 1
+    bump_graph_version()
+
+# networkx view of the arrays (fallback router / ad-hoc analysis)
+def _ensure_nx_graph():
+    if KD_IDX is None:
+        _init_route_graph()
+    if G_ROUTE.number_of_nodes() == 0 and len(NODE_LATLNG):
+        G_ROUTE.add_nodes_from(
+            (i, {"pos": (lat, lng)}) for i, (lat, lng) in enumerate(NODE_LATLNG.tolist()))
+        G_ROUTE.add_edges_from(
+            (u, v, {"weight": w, "row": r})
+            for (u, v), w, r in zip(EDGE_UV.tolist(), EDGE_W.tolist(), EDGE_ROW.tolist()))
+    return G_ROUTE
 
 # nearest‑node lookup
 def _nearest_node(lat, lng):
     if KD_IDX is None:
         _init_route_graph()
     dist, idx = KD_IDX.query([lat, lng])
-    nid = list(G_ROUTE.nodes())[idx]
-    return nid
+    return int(KD_NODE_IDS[idx])
 
+# Batch snapping: one KD‑Tree query for many points.
+# Returns (node_ids, snap_dist_m); points further than max_snap_m from the
+# network get node id -1. Pass max_snap_m=None to disable the cutoff.
+def snap_points(lats, lngs, max_snap_m=MAX_SNAP_M):
+    if KD_IDX is None:
+        _init_route_graph()
+    lats = np.asarray(lats, dtype=float).ravel()
+    lngs = np.asarray(lngs, dtype=float).ravel()
+    _, idx = KD_IDX.query(np.column_stack([lats, lngs]))
+    node_ll = NODE_LATLNG[idx]
+    dist_m = haversine_np(lats, lngs, node_ll[:, 0], node_ll[:, 1]) * 1000.0
+    node_ids = KD_NODE_IDS[idx].copy()
+    if max_snap_m is not None:
+        node_ids[dist_m > max_snap_m] = -1
+    return node_ids, dist_m
@@ -0,0 +1,103 @@
+# events.py – in-process pub/sub bus behind the /api/stream SSE endpoint
+# Write paths publish compact events (a type, a JSON payload and optionally a
+# location). Each event is serialised to its SSE frame once and handed to
+# every subscriber whose bbox/type filter matches. Subscribers hold a bounded
+# buffer: when a slow client falls behind the oldest frames are dropped and
+# the client is told to resync (re-fetch with ?since_version=) instead of the
+# server queueing without limit.
+# Only writes made by this process are seen; run one worker per bus.
+import itertools
+import json
+import threading
+from collections import deque
+
+EVENT_BUFFER = 256            # frames buffered per client before the oldest are dropped
+EVENT_MAX_CLIENTS = 5000
+EVENT_KEEPALIVE_S = 15        # comment line sent to idle clients (keeps proxies from timing out)
+EVENT_RETRY_MS = 3000         # EventSource reconnect delay
+
+_seq = itertools.count(1)
+_subscribers = set()
+_lock = threading.Lock()
+
+class Subscriber:
+    def __init__(self, bbox=None, types=None, maxlen=EVENT_BUFFER):
+        self.bbox = bbox              # (min_lng, min_lat, max_lng, max_lat) or None
+        self.types = types            # set of event types or None for all
+        self.dropped = 0
+        self._frames = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+
+    def wants(self, etype, lat, lng):
+        if self.types is not None and etype not in self.types:
+            return False
+        if self.bbox is None or lat is None or lng is None:
+            return True               # unlocated events go to everyone
+        x0, y0, x1, y1 = self.bbox
+        in_lng = x0 <= lng <= x1 if x0 <= x1 else (lng >= x0 or lng <= x1)   # antimeridian
+        return in_lng and y0 <= lat <= y1
+
+    def push(self, frame):
+        with self._cond:
+            if len(self._frames) == self._frames.maxlen:
+                self.dropped += 1
+            self._frames.append(frame)
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """Block until frames arrive (or timeout); returns (frames, dropped since last call)."""
+        with self._cond:
+            if not self._frames:
+                self._cond.wait(timeout)
+            frames = list(self._frames)
+            self._frames.clear()
+            dropped, self.dropped = self.dropped, 0
+        return frames, dropped
+
+def subscribe(bbox=None, types=None):
+    """Register a client; returns None when EVENT_MAX_CLIENTS are connected."""
+    sub = Subscriber(bbox, types)
+    with _lock:
+        if len(_subscribers) >= EVENT_MAX_CLIENTS:
+            return None
+        _subscribers.add(sub)
+    return sub
+
+def unsubscribe(sub):
+    with _lock:
+        _subscribers.discard(sub)
+
+def frame(etype, data, event_id=None):
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {etype}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+def publish(etype, data, lat=None, lng=None):
+    publish_many(etype, [(data, lat, lng)])
+
+def publish_many(etype, items):
+    """
+    items: list of (data, lat, lng). A batch larger than a client buffer would
+    only be dropped again, so it goes out as a single resync event instead.
+    """
+    with _lock:
+        subs = [s for s in _subscribers if s.types is None or etype in s.types]
+    if not subs:
+        return
+    if len(items) > EVENT_BUFFER:
+        f = frame("resync", {"type": etype, "count": len(items)}, next(_seq))
+        for s in subs:
+            s.push(f)
+        return
+    for data, lat, lng in items:
+        try:
+            lat, lng = float(lat), float(lng)
+        except (TypeError, ValueError):
+            lat = lng = None
+        f = frame(etype, data, next(_seq))
+        for s in subs:
+            if s.wants(etype, lat, lng):
+                s.push(f)
+
+def client_count():
+    with _lock:
+        return len(_subscribers)
@@ -1,22 +1,40 @@
 # fire_building_viz.py 北美单位版 🗽
 # 功能：交互式火点与建筑数据地图（英尺/平方英尺单位）
+#
+# 分两步：
+#   1. build_artifacts()  清洗火点 + 建筑脆弱性评分，结果写入带版本号的
+#      GeoParquet 产物；只有输入文件内容哈希变化时才重新计算。
+#   2. render_map()       生成 Folium 地图（仅命令行运行时执行）。
+# API 端通过 get_fire_df() / get_bldg_gdf() 惰性读取产物，import 本模块不做任何计算。
+#
+# 火点 CSV 通过 firms.py 增量摄取（只解析新追加的行并去重），refresh_fires()
+# 可在服务运行时把新行追加到内存中的 fire_df 并通知下游缓存。
+#
+# 命令行：python fire.py [--force] [--no-map] [--ingest]
 
 FIRE_CSV = r"fire_total.csv"
 BLDG_JSON = r"2023_Buildings_with_DINS_data.geojson"
 FUEL_TIF = r"燃料数据.tif"
 OUT_HTML = "fire_building_map.html"
 
+import hashlib
+import json
+import os
+import re
+import threading
+from functools import lru_cache
+from pathlib import Path
+
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-import folium
-import rasterio
-import json
-import re
-from rasterstats import zonal_stats
-from folium.plugins import MeasureControl
-from branca.element import MacroElement, Template
-from shapely.geometry import Point
+
+# ------------------ 产物（artifact）设置 ------------------
+ARTIFACT_DIR = Path("outputs/artifacts")
+ARTIFACT_VERSION = 2  # 清洗/评分逻辑变化时递增，旧产物自动失效
+MANIFEST = ARTIFACT_DIR / "manifest.json"
+FIRES_ARTIFACT = ARTIFACT_DIR / f"fires_v{ARTIFACT_VERSION}.parquet"
+BLDG_ARTIFACT = ARTIFACT_DIR / f"buildings_v{ARTIFACT_VERSION}.parquet"
 
 # ------------------ 单位转换常数 ------------------
 M_TO_FT = 3.28084  # 米转英尺
@@ -67,189 +85,519 @@ def clean_coordinate(coord, coord_type):
     except (TypeError, ValueError, AttributeError):
         return np.nan
 
+_COORD_RANGE = {"latitude": (-90, 90), "longitude": (-180, 180)}
+
+
+def clean_coordinates(values, coord_type):
+    """
+    clean_coordinate 的向量化版本：对整列做同样的清洗（逗号转小数点、
+    取开头的数值、范围校验、保留 6 位小数），无效值为 NaN
+    """
+    if coord_type not in _COORD_RANGE:
+        raise ValueError(f"无效坐标类型: {coord_type}")
+    lo, hi = _COORD_RANGE[coord_type]
+    text = pd.Series(values).astype("string").str.strip().str.replace(",", ".", regex=False)
+    val = pd.to_numeric(text.str.extract(r"^([-+]?\d*\.?\d+)", expand=False), errors="coerce")
+    val = val.astype("float64").where((val >= lo) & (val <= hi))
+    return val.round(6)
+
 
 # ------------------ 数据预处理 ------------------
-# 1. 火点数据处理（增强清洗）
-try:
-    fire_df = pd.read_csv(FIRE_CSV, parse_dates=["datetime"])
-
-    # 验证必要字段
-    required_cols = ["latitude", "longitude", "datetime", "track", "scan"]
-    missing_cols = [col for col in required_cols if col not in fire_df.columns]
-    if missing_cols:
-        raise ValueError(f"火点数据缺少必要字段: {', '.join(missing_cols)}")
-
-    # 数据清洗
-    fire_df = fire_df.assign(
-        latitude=fire_df["latitude"].apply(
-            lambda x: clean_coordinate(x, 'latitude')
-        ),
-        longitude=fire_df["longitude"].apply(
-            lambda x: clean_coordinate(x, 'longitude')
+FIRMS_CHUNK_ROWS = 200_000  # 每批读取行数
+# FIRMS 数值列的目标类型（可空）；按文本读入后逐列 to_numeric，
+# 空值和无法解析的值都记为缺失（行保留），避免一个脏值中断整次分块读取
+FIRMS_NUMERIC = {
+    "brightness": "float64", "scan": "float64", "track": "float64",
+    "acq_time": "Int64", "bright_t31": "float64", "frp": "float64",
+}
+# FIRMS 导出的显式列类型；经纬度按原始文本读入，交给 clean_coordinates 清洗
+FIRMS_DTYPES = {
+    "latitude": str, "longitude": str, "acq_date": str, "satellite": str,
+    "instrument": str, "confidence": str, "version": str, "daynight": str,
+    **{col: str for col in FIRMS_NUMERIC},
+}
+REQUIRED_FIRE_COLS = ["latitude", "longitude", "datetime", "track", "scan"]
+
+
+def iter_fire_batches(path=FIRE_CSV, chunksize=FIRMS_CHUNK_ROWS, **read_kw):
+    """
+    分块读取火点 CSV，逐批 yield (清洗后的 DataFrame, 被剔除的行数)。
+    内存占用只与 chunksize 有关；缺少必要字段时抛出 ValueError
+    """
+    reader = pd.read_csv(path, parse_dates=["datetime"], dtype=FIRMS_DTYPES,
+                         chunksize=chunksize, **read_kw)
+    with reader:
+        for chunk in reader:
+            # 验证必要字段
+            missing_cols = [col for col in REQUIRED_FIRE_COLS if col not in chunk.columns]
+            if missing_cols:
+                raise ValueError(f"火点数据缺少必要字段: {', '.join(missing_cols)}")
+
+            # 数值列：空值、无法解析（或 acq_time 非整数）-> 缺失，整行保留；
+            # 只有经纬度无效的行才剔除
+            numeric = {}
+            for col, dtype in FIRMS_NUMERIC.items():
+                if col not in chunk.columns:
+                    continue
+                val = pd.to_numeric(chunk[col].str.strip(), errors="coerce").astype("float64")
+                if dtype == "Int64":
+                    val = val.where(val % 1 == 0)
+                numeric[col] = val.astype(dtype)
+
+            # 数据清洗
+            batch = chunk.assign(
+                latitude=clean_coordinates(chunk["latitude"], "latitude"),
+                longitude=clean_coordinates(chunk["longitude"], "longitude"),
+                **numeric
+            ).dropna(subset=["latitude", "longitude"])
+            yield batch, len(chunk) - len(batch)
+
+
+def load_fire_csv(path=FIRE_CSV):
+    """读取并清洗火点 CSV（增强清洗），失败时抛出 ValueError"""
+    batches = [batch for batch, _ in iter_fire_batches(path)]
+    if not batches:
+        raise ValueError("火点数据为空")
+    return pd.concat(batches) if len(batches) > 1 else batches[0]
+
+
+# ------------------ 燃料分区统计（分块窗口读取 + 多进程） ------------------
+ZONAL_CHUNK = 2000              # 每块建筑数
+ZONAL_MAX_WINDOW_PX = 4096 ** 2  # 单块最多读取的栅格像元数（控制峰值内存）
+ZONAL_WORKERS = None            # None = os.cpu_count()
+
+
+def _zonal_chunk(args):
+    """子进程：只读取覆盖本块建筑的栅格窗口，返回 (行号, 燃料均值)"""
+    import rasterio
+    import shapely
+    from rasterio.errors import WindowError
+    from rasterio.windows import Window, from_bounds
+    from rasterstats import zonal_stats
+
+    fuel_path, positions, wkbs = args
+    geoms = shapely.from_wkb(wkbs)
+    with rasterio.open(fuel_path) as src:
+        win = from_bounds(*shapely.total_bounds(geoms), transform=src.transform)
+        # 向外扩 1 像元，保证与整幅读取时的像元选择一致
+        win = Window(int(np.floor(win.col_off)) - 1, int(np.floor(win.row_off)) - 1,
+                     int(np.ceil(win.width)) + 3, int(np.ceil(win.height)) + 3)
+        try:
+            win = win.intersection(Window(0, 0, src.width, src.height))
+        except WindowError:  # 与栅格无重叠
+            return positions, [0] * len(positions)
+        zs = zonal_stats(
+            list(geoms),
+            src.read(1, window=win),
+            affine=src.window_transform(win),
+            stats=["mean"],
+            nodata=src.nodata
         )
-    ).dropna(subset=["latitude", "longitude"])
-
-except Exception as e:
-    print(f"火点数据加载失败: {str(e)}")
-    exit()
-
-# 2. 建筑数据处理（单位转换与安全检查）
-bldg_gdf = gpd.read_file(BLDG_JSON).to_crs("EPSG:4326")
-bldg_gdf = bldg_gdf.assign(
-    height_ft=(bldg_gdf["HEIGHT"].fillna(0) * M_TO_FT).clip(lower=0),
-    area_sqft=(bldg_gdf["AREA"].fillna(0) * (M_TO_FT ** 2)).clip(lower=0)
-).query("height_ft >= 0 and area_sqft >= 0")
-
-# 3. 燃料数据处理（安全计算）
-with rasterio.open(FUEL_TIF) as src:
-    zs = zonal_stats(
-        bldg_gdf.geometry,
-        src.read(1),
-        affine=src.transform,
-        stats=["mean"],
-        nodata=src.nodata
-    )
-fuel_mean = np.array([z["mean"] or 0 for z in zs])
-
-# 安全归一化计算
-height_max = bldg_gdf["height_ft"].max() or 1
-area_max = bldg_gdf["area_sqft"].max() or 1
-fuel_normalized = fuel_mean / fuel_mean.max() if fuel_mean.max() > 0 else np.zeros_like(fuel_mean)
-
-bldg_gdf["vulnerability"] = (
-        0.5 * (bldg_gdf["height_ft"] / height_max) +
-        0.3 * (bldg_gdf["area_sqft"] / area_max) +
-        0.2 * fuel_normalized
-).clip(0, 1)
-
-# ------------------ 地图初始化 ------------------
-if fire_df.empty:
-    raise ValueError("清洗后无有效火点数据")
-
-center = [fire_df["latitude"].mean(), fire_df["longitude"].mean()]
-m = folium.Map(
-    location=center,
-    zoom_start=10,
-    tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-    attr='Esri World Imagery',
-    control_scale=True
-)
-
-
-# ------------------ 建筑图层 ------------------
-def get_color(feature):
-    h = feature['properties']['height_ft']
-    return (
-        '#FFEDA0' if h < 32.8 else
-        '#FEDD70' if h < 65.6 else
-        '#FEB24C' if h < 98.4 else
-        '#FDBD3C' if h < 164 else
-        '#FC4E2A' if h < 328 else
-        '#E31A1C'
-    )
+    return positions, [z["mean"] or 0 for z in zs]
+
+
+def _zonal_tasks(geoms, fuel_path, chunk):
+    """按 Hilbert 曲线排序后切块；窗口过大的块继续对半拆分"""
+    import rasterio
+    import shapely
+
+    with rasterio.open(fuel_path) as src:
+        px_area = abs(src.res[0] * src.res[1])
+    geoms = np.asarray(geoms)
+    order = np.argsort(gpd.GeoSeries(geoms).hilbert_distance().to_numpy(), kind="stable")
+    stack = [order[i:i + chunk] for i in range(0, len(order), chunk)][::-1]
+    wkbs = shapely.to_wkb(geoms)
+    while stack:
+        pos = stack.pop()
+        x0, y0, x1, y1 = shapely.total_bounds(geoms[pos])
+        if len(pos) > 1 and (x1 - x0) * (y1 - y0) / px_area > ZONAL_MAX_WINDOW_PX:
+            half = len(pos) // 2
+            stack += [pos[half:], pos[:half]]
+            continue
+        yield fuel_path, pos, wkbs[pos]
+
+
+def compute_fuel_mean(geoms, fuel_path=FUEL_TIF, chunk=ZONAL_CHUNK, workers=ZONAL_WORKERS):
+    """
+    每栋建筑的燃料均值（无数据为 0），顺序与 geoms 一致。
+    栅格从不整幅读入内存：峰值内存只取决于单块窗口大小。
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    fuel_mean = np.zeros(len(geoms))
+    tasks = _zonal_tasks(geoms, fuel_path, chunk)
+    if len(geoms) <= chunk or workers == 1:  # 小数据直接串行，省去进程启动
+        for positions, means in map(_zonal_chunk, tasks):
+            fuel_mean[positions] = means
+        return fuel_mean
+    # spawn 而非 fork：服务端在请求线程里惰性构建，此时任务队列/SSE 等线程仍在运行，
+    # fork 时若有线程持锁，子进程会死锁（同 routing.py 的进程池）
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        for positions, means in pool.map(_zonal_chunk, tasks):  # 结果按块流式写回
+            fuel_mean[positions] = means
+    return fuel_mean
+
+
+def score_buildings(bldg_path=BLDG_JSON, fuel_path=FUEL_TIF):
+    """建筑数据处理（单位转换）+ 燃料分区统计 + 脆弱性指数"""
+    bldg_gdf = gpd.read_file(bldg_path).to_crs("EPSG:4326")
+    bldg_gdf = bldg_gdf.assign(
+        height_ft=(bldg_gdf["HEIGHT"].fillna(0) * M_TO_FT).clip(lower=0),
+        area_sqft=(bldg_gdf["AREA"].fillna(0) * (M_TO_FT ** 2)).clip(lower=0)
+    ).query("height_ft >= 0 and area_sqft >= 0")
+
+    # 燃料分区统计 + 归一化评分：交给按建筑 ID 持久化的 vulnerability 库，
+    # 只重算新增/变化的建筑，归一化最大值变化时才整体重缩放
+    import vulnerability
+    vulnerability.sync(bldg_gdf, fuel_path)
+    bldg_gdf["vulnerability"] = vulnerability.vulnerability_for(vulnerability.building_ids(bldg_gdf))
+    return bldg_gdf
+
+
+# ------------------ 产物构建（按输入哈希增量） ------------------
+_build_lock = threading.Lock()
+
+
+def _read_manifest():
+    try:
+        return json.loads(MANIFEST.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
 
 
-def style_function(feature):
-    try:
-        vul = float(feature['properties'].get('vulnerability', 0.0))
-        opacity = max(0.0, min(1.0, 0.6 * vul + 0.2))
-    except:
-        vul = 0.0
-        opacity = 0.2
-
-    return {
-        'fillColor': get_color(feature),
-        'color': '#444',
-        'weight': 0.5,
-        'fillOpacity': opacity
-    }
-
-
-folium.GeoJson(
-    bldg_gdf,
-    name='🏢 建筑',
-    style_function=style_function,
-    popup=folium.GeoJsonPopup(
-        fields=['height_ft', 'area_sqft', 'vulnerability'],
-        aliases=['高度（英尺）', '面积（平方英尺）', '脆弱性指数'],
-        localize=True
-    ),
-    tooltip=folium.GeoJsonTooltip(
-        fields=["height_ft"],
-        aliases=["建筑高度："]
-    )
-).add_to(m)
-
-# ------------------ 火点图层（含2km缓冲区）------------------
-fires_fg = folium.FeatureGroup(name='🔥 火点', show=True)
-
-for idx, row in fire_df.iterrows():
-    # 信息弹窗
-    popup_html = f"""
-    <div style="min-width:250px;">
-        <h4 style="color:#d9534f; margin:0 0 8px;">火点详情</h4>
-        <div><b>时间：</b>{row['datetime'].strftime('%Y-%m-%d %H:%M')}</div>
-        <div><b>坐标：</b>{row['latitude']:.4f}°N, {row['longitude']:.4f}°E</div>
-        <div><b>轨道：</b>{row['track']}</div>
-        <div><b>扫描：</b>{row['scan']}</div>
-    </div>
+def _input_hash(path, known=None):
+    """文件内容 SHA-1；大小与修改时间未变时直接沿用 manifest 中的记录"""
+    st = os.stat(path)
+    if known and known.get("size") == st.st_size and known.get("mtime_ns") == st.st_mtime_ns:
+        return known
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return {"sha1": h.hexdigest(), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _atomic_parquet(df, path):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def _build_fires():
+    """增量摄取新追加的火点行，再从火点库导出完整产物"""
+    import firms
+    firms.ingest(FIRE_CSV)
+    return firms.load_fires()
+
+
+# 阶段名 -> (输入文件, 产物路径, 构建函数)
+STAGES = {
+    "fires": ((FIRE_CSV,), FIRES_ARTIFACT, _build_fires),
+    "buildings": ((BLDG_JSON, FUEL_TIF), BLDG_ARTIFACT, lambda: score_buildings(BLDG_JSON, FUEL_TIF)),
+}
+
+
+def build_artifacts(force=False, stages=None):
+    """
+    重新计算输入已变化（或产物缺失）的阶段，返回实际重建的阶段名列表。
+    输入未变时只做 stat，不读取大文件。
     """
+    rebuilt = []
+    with _build_lock:
+        ARTIFACT_DIR.mkdir(parents=True, exist_ok=True)
+        manifest = _read_manifest()
+        for name in stages or STAGES:
+            inputs, artifact, build = STAGES[name]
+            entry = manifest.get(name, {})
+            hashes = {p: _input_hash(p, entry.get("inputs", {}).get(p)) for p in inputs}
+            fresh = (
+                not force
+                and artifact.exists()
+                and entry.get("version") == ARTIFACT_VERSION
+                and {p: h["sha1"] for p, h in hashes.items()}
+                == {p: h.get("sha1") for p, h in entry.get("inputs", {}).items()}
+            )
+            if not fresh:
+                _atomic_parquet(build(), artifact)
+                rebuilt.append(name)
+            manifest[name] = {"version": ARTIFACT_VERSION, "artifact": str(artifact),
+                              "inputs": hashes}
+        tmp = MANIFEST.with_name(f"{MANIFEST.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(manifest, indent=2, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, MANIFEST)
+    return rebuilt
+
+
+# ------------------ 惰性读取（API 使用） ------------------
+_fire_df = None
+_fire_lock = threading.Lock()
+_fire_listeners = []  # 追加新火点后回调 fn(new_rows)
+
+
+def get_fire_df():
+    global _fire_df
+    with _fire_lock:
+        if _fire_df is None:
+            build_artifacts(stages=["fires"])
+            _fire_df = pd.read_parquet(FIRES_ARTIFACT)
+        return _fire_df
+
+
+def on_fires_appended(fn):
+    """注册下游缓存的增量更新回调"""
+    _fire_listeners.append(fn)
+    return fn
+
+
+def refresh_fires(path=FIRE_CSV):
+    """
+    摄取 CSV 新追加的行：追加到已加载的 fire_df 并通知监听者（不整体重建）。
+    传给监听者的新行以其在 fire_df 中的行号为索引，监听者据此跳过已读到的行
+    （回调在锁外执行，期间可能已有读者拿到追加后的 fire_df）。
+    fire_df 尚未加载时不通知：之后的首次加载本身就包含这些行。
+    返回 (新增行, 被剔除行数)
+    """
+    global _fire_df
+    import firms
+    new, rejected = firms.ingest(path)
+    if len(new):
+        with _fire_lock:
+            if _fire_df is None:
+                return new, rejected
+            start = len(_fire_df)
+            _fire_df = pd.concat([_fire_df, new[_fire_df.columns]], ignore_index=True)
+        appended = new.set_axis(pd.RangeIndex(start, start + len(new)))
+        for fn in _fire_listeners:
+            fn(appended)
+    return new, rejected
+
+
+@lru_cache(maxsize=1)
+def get_bldg_gdf():
+    build_artifacts(stages=["buildings"])
+    return gpd.read_parquet(BLDG_ARTIFACT)
+
+
+def __getattr__(name):
+    # 兼容旧用法 fire.fire_df / fire.bldg_gdf（首次访问时才加载）
+    if name == "fire_df":
+        return get_fire_df()
+    if name == "bldg_gdf":
+        return get_bldg_gdf()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# ------------------ 地图 ------------------
+FIRE_MARKER_LIMIT = 2000  # auto 模式下超过该火点数改用聚类渲染
+
+# 聚类模式的单点回调：row = [lat, lng, time, track, scan, frp]
+FIRE_CLUSTER_CALLBACK = """
+function (row) {
+    var frp = row[5];
+    var color = frp >= 100 ? '#7f0000' : frp >= 20 ? '#cc0000' : '#ff0000';
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: frp >= 100 ? 6 : 4, color: color, fill: true, fillOpacity: 0.8
+    });
+    marker.bindPopup(function() {
+        return '<div style="min-width:250px;">'
+            + '<h4 style="color:#d9534f; margin:0 0 8px;">火点详情</h4>'
+            + '<div><b>时间：</b>' + row[2] + '</div>'
+            + '<div><b>坐标：</b>' + row[0].toFixed(4) + '°N, ' + row[1].toFixed(4) + '°E</div>'
+            + '<div><b>轨道：</b>' + row[3] + '</div>'
+            + '<div><b>扫描：</b>' + row[4] + '</div>'
+            + '<div><b>FRP：</b>' + row[5] + ' MW</div>'
+            + '</div>';
+    }, {maxWidth: 300});
+    return marker;
+}
+"""
+
+
+def render_map(fire_df, bldg_gdf, out_html=OUT_HTML, fire_mode="auto"):
+    """
+    生成交互式 Folium 地图并打印数据质量报告
+    fire_mode: "markers" 逐点圆圈+缓冲区；"cluster" 按日期聚类（适合整季 FIRMS 数据）；
+               "auto" 按 FIRE_MARKER_LIMIT 自动选择
+    """
+    import folium
+    from folium.plugins import MeasureControl
+    from branca.element import MacroElement, Template
+
+    # ------------------ 地图初始化 ------------------
+    if fire_df.empty:
+        raise ValueError("清洗后无有效火点数据")
+
+    center = [fire_df["latitude"].mean(), fire_df["longitude"].mean()]
+    m = folium.Map(
+        location=center,
+        zoom_start=10,
+        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        attr='Esri World Imagery',
+        control_scale=True
+    )
+
+
+    # ------------------ 建筑图层 ------------------
+    def get_color(feature):
+        h = feature['properties']['height_ft']
+        return (
+            '#FFEDA0' if h < 32.8 else
+            '#FEDD70' if h < 65.6 else
+            '#FEB24C' if h < 98.4 else
+            '#FDBD3C' if h < 164 else
+            '#FC4E2A' if h < 328 else
+            '#E31A1C'
+        )
+
+
+    def style_function(feature):
+        try:
+            vul = float(feature['properties'].get('vulnerability', 0.0))
+            opacity = max(0.0, min(1.0, 0.6 * vul + 0.2))
+        except:
+            vul = 0.0
+            opacity = 0.2
+
+        return {
+            'fillColor': get_color(feature),
+            'color': '#444',
+            'weight': 0.5,
+            'fillOpacity': opacity
+        }
+
+
+    folium.GeoJson(
+        bldg_gdf,
+        name='🏢 建筑',
+        style_function=style_function,
+        popup=folium.GeoJsonPopup(
+            fields=['height_ft', 'area_sqft', 'vulnerability'],
+            aliases=['高度（英尺）', '面积（平方英尺）', '脆弱性指数'],
+            localize=True
+        ),
+        tooltip=folium.GeoJsonTooltip(
+            fields=["height_ft"],
+            aliases=["建筑高度："]
+        )
+    ).add_to(m)
+
+    # ------------------ 火点图层（含2km缓冲区）------------------
+    fires_fg = folium.FeatureGroup(name='🔥 火点', show=True)
+    day = fire_df['datetime'].dt.strftime('%Y-%m-%d')
+    dates = sorted(day.unique())
+    if fire_mode == "auto":
+        fire_mode = "cluster" if len(fire_df) > FIRE_MARKER_LIMIT else "markers"
+
+    # 每个日期一个子图层（挂在 fires_fg 下），日期筛选直接增删子图层
+    date_layers = {}
+    if fire_mode == "markers":
+        for d in dates:
+            date_layers[d] = folium.FeatureGroup(name=d, control=False).add_to(fires_fg)
+
+        for (idx, row), d in zip(fire_df.iterrows(), day):
+            # 信息弹窗
+            popup_html = f"""
+            <div style="min-width:250px;">
+                <h4 style="color:#d9534f; margin:0 0 8px;">火点详情</h4>
+                <div><b>时间：</b>{row['datetime'].strftime('%Y-%m-%d %H:%M')}</div>
+                <div><b>坐标：</b>{row['latitude']:.4f}°N, {row['longitude']:.4f}°E</div>
+                <div><b>轨道：</b>{row['track']}</div>
+                <div><b>扫描：</b>{row['scan']}</div>
+            </div>
+            """
+
+            # 2公里缓冲区
+            folium.Circle(
+                location=[row['latitude'], row['longitude']],
+                radius=2000,
+                color='#ff4500',
+                fill_color='#ff6347',
+                fill_opacity=0.2,
+                weight=1,
+                popup=folium.Popup(popup_html, max_width=300),
+                smooth_factor=0.5
+            ).add_to(date_layers[d])
+
+            # 中心点标记
+            folium.CircleMarker(
+                location=[row['latitude'], row['longitude']],
+                radius=4,
+                color='#ff0000',
+                fill=True,
+                fill_opacity=0.8,
+                popup=folium.Popup(popup_html, max_width=300)
+            ).add_to(date_layers[d])
+    elif fire_mode == "cluster":
+        # 大数据量：每个日期一份紧凑数组 + 浏览器端聚类，标记、颜色（按 FRP）
+        # 和弹窗都由 JS 回调生成，Python 端不创建逐点对象；缓冲区在此模式下省略
+        from folium.plugins import FastMarkerCluster
+
+        rows = pd.DataFrame({
+            "latitude": fire_df["latitude"],
+            "longitude": fire_df["longitude"],
+            "time": fire_df["datetime"].dt.strftime('%Y-%m-%d %H:%M'),
+            "track": fire_df["track"],
+            "scan": fire_df["scan"],
+            "frp": fire_df["frp"].fillna(0) if "frp" in fire_df else 0.0,
+        })
+        for d, part in rows.groupby(day.to_numpy(), sort=True):
+            date_layers[d] = FastMarkerCluster(
+                part.to_numpy().tolist(),
+                callback=FIRE_CLUSTER_CALLBACK,
+                name=d,
+                control=False,
+                disableClusteringAtZoom=14,
+                chunkedLoading=True
+            ).add_to(fires_fg)
+    else:
+        raise ValueError(f"未知火点渲染模式: {fire_mode}")
+
+    # 图例只列出当前模式实际绘制的图层
+    if fire_mode == "markers":
+        legend_items = [("background:#ff4500;opacity:0.2;", "2公里缓冲区"),
+                        ("background:#ff0000;", "火点中心")]
+    else:
+        legend_items = [("background:#ff0000;", "火点 FRP <20 MW"),
+                        ("background:#cc0000;", "火点 FRP 20-100 MW"),
+                        ("background:#7f0000;", "火点 FRP ≥100 MW")]
+    legend_items.append(("background:#E31A1C;", "高层建筑 >328ft"))
+    legend_html = "".join(f'<div><div class="legend-icon" style="{style}"></div>{label}</div>'
+                          for style, label in legend_items)
+
+    # ------------------ 交互组件 ------------------
+    layer_js = ", ".join(f'"{d}": {layer.get_name()}' for d, layer in date_layers.items())
+    macro = MacroElement()
+    macro._template = Template(f"""
+    {{% macro header(this, kwargs) %}}
+        <style>
+            .leaflet-control-datefilter {{
+                background: white;
+                padding: 10px;
+                border-radius: 5px;
+                box-shadow: 0 1px 5px rgba(0,0,0,0.4);
+            }}
+            .legend {{
+                background: white;
+                padding: 10px;
+                line-height: 1.5;
+            }}
+            .legend-icon {{
+                width: 20px;
+                height: 20px;
+                display: inline-block;
+                margin-right: 5px;
+            }}
+        </style>
+    {{% endmacro %}}
+
+    {{% macro script(this, kwargs) %}}
+        (function() {{
+            var map = {m.get_name()};
+            var fireLayer = {fires_fg.get_name()};
+            var dateLayers = {{{layer_js}}};
 
-    # 2公里缓冲区
-    folium.Circle(
-        location=[row['latitude'], row['longitude']],
-        radius=2000,
-        color='#ff4500',
-        fill_color='#ff6347',
-        fill_opacity=0.2,
-        weight=1,
-        popup=folium.Popup(popup_html, max_width=300),
-        smooth_factor=0.5
-    ).add_to(fires_fg)
-
-    # 中心点标记
-    folium.CircleMarker(
-        location=[row['latitude'], row['longitude']],
-        radius=4,
-        color='#ff0000',
-        fill=True,
-        fill_opacity=0.8,
-        popup=folium.Popup(popup_html, max_width=300)
-    ).add_to(fires_fg)
-
-# ------------------ 交互组件 ------------------
-dates = sorted(fire_df['datetime'].dt.strftime('%Y-%m-%d').unique())
-macro = MacroElement()
-macro._template = Template(f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <style>
-        .leaflet-control-datefilter {{
-            background: white;
-            padding: 10px;
-            border-radius: 5px;
-            box-shadow: 0 1px 5px rgba(0,0,0,0.4);
-        }}
-        .legend {{
-            background: white;
-            padding: 10px;
-            line-height: 1.5;
-        }}
-        .legend-icon {{
-            width: 20px;
-            height: 20px;
-            display: inline-block;
-            margin-right: 5px;
-        }}
-    </style>
-</head>
-<body>
-    <script>
-        var fireLayer = L.featureGroup();
-        var dateSelect = null;
-
-        map.whenReady(function() {{
             // 日期选择器
             var dateControl = L.control({{position: 'topright'}});
             dateControl.onAdd = function() {{
@@ -261,6 +609,7 @@ macro._template = Template(f"""
                         {"".join([f'<option value="{d}">{d}</option>' for d in dates])}
                     </select>
                 `;
+                L.DomEvent.disableClickPropagation(div);
                 return div;
             }};
             dateControl.addTo(map);
@@ -271,66 +620,79 @@ macro._template = Template(f"""
                 var div = L.DomUtil.create('div', 'legend');
                 div.innerHTML = `
                     <h4>图例说明</h4>
-                    <div><div class="legend-icon" style="background:#ff4500;opacity:0.2;"></div>2公里缓冲区</div>
-                    <div><div class="legend-icon" style="background:#ff0000;"></div>火点中心</div>
-                    <div><div class="legend-icon" style="background:#E31A1C;"></div>高层建筑 >328ft</div>
+                    {legend_html}
                 `;
                 return div;
             }};
             legend.addTo(map);
 
-            // 日期筛选功能
+            // 日期筛选功能：按日期增删子图层
             document.getElementById('dateSelect').addEventListener('change', function() {{
                 var selectedDate = this.value;
-                fireLayer.eachLayer(function(layer) {{
-                    if(selectedDate === 'all' || layer.date === selectedDate) {{
-                        map.addLayer(layer);
+                Object.keys(dateLayers).forEach(function(date) {{
+                    if (selectedDate === 'all' || date === selectedDate) {{
+                        fireLayer.addLayer(dateLayers[date]);
                     }} else {{
-                        map.removeLayer(layer);
+                        fireLayer.removeLayer(dateLayers[date]);
                     }}
                 }});
             }});
-        }});
-    </script>
-</body>
-</html>
-""")
-
-m.get_root().add_child(macro)
-m.add_child(MeasureControl(position='topleft', primary_length_unit='miles'))
-fires_fg.add_to(m)
-folium.LayerControl().add_to(m)
-
-# ------------------ 数据质量报告 ------------------
-print("=== 数据质量报告 ===")
-print(f"建筑数量：{len(bldg_gdf)}")
-print(f"建筑高度范围：{bldg_gdf.height_ft.min():.1f} - {bldg_gdf.height_ft.max():.1f} ft")
-print(f"火点时间范围：{fire_df.datetime.min().strftime('%Y-%m-%d')} 至 {fire_df.datetime.max().strftime('%Y-%m-%d')}")
-print(f"轨道标识范围：{fire_df.track.min()} - {fire_df.track.max()}")
-print("扫描类型分布：")
-print(fire_df.scan.value_counts().to_string())
-
-# === ADD just above the existing m.save(...) line =========================
-def get_fire_layers_geojson():
-    """
-    Return two ready‑to‑serve blobs:
-      • GeoJSON for the buildings layer
-      • Plain‑dict list for the fire points
-    Nothing heavy is recomputed here – it reuses the
-    already‑loaded bldg_gdf / fire_df that fire.py prepared on import.
-    """
-    # GeoPandas → GeoJSON string → dict (so Flask can jsonify it)
-    buildings_geojson = json.loads(
-        bldg_gdf.to_crs(epsg=4326).to_json()
-    )
-    fires_list = (
-        fire_df[["latitude", "longitude", "datetime", "track", "scan"]]
+        }})();
+    {{% endmacro %}}
+    """)
+
+    m.get_root().add_child(macro)
+    m.add_child(MeasureControl(position='topleft', primary_length_unit='miles'))
+    fires_fg.add_to(m)
+    folium.LayerControl().add_to(m)
+
+    # ------------------ 数据质量报告 ------------------
+    print("=== 数据质量报告 ===")
+    print(f"建筑数量：{len(bldg_gdf)}")
+    print(f"建筑高度范围：{bldg_gdf.height_ft.min():.1f} - {bldg_gdf.height_ft.max():.1f} ft")
+    print(f"火点时间范围：{fire_df.datetime.min().strftime('%Y-%m-%d')} 至 {fire_df.datetime.max().strftime('%Y-%m-%d')}")
+    print(f"轨道标识范围：{fire_df.track.min()} - {fire_df.track.max()}")
+    print("扫描类型分布：")
+    print(fire_df.scan.value_counts().to_string())
+
+    # ------------------ 保存地图 ------------------
+    m.save(out_html)
+    print(f"\n✅ 地图已生成：{out_html}")
+
+
+# ------------------ API 数据 ------------------
+def get_fire_records(mask=None, df=None):
+    """火点列表（可选布尔掩码过滤），即 /api/fire_layers 中的 fires 部分"""
+    fire_df = get_fire_df() if df is None else df
+    df = fire_df if mask is None else fire_df[mask]
+    return (
+        df[["latitude", "longitude", "datetime", "track", "scan"]]
         .applymap(convert_numpy_types)
         .to_dict("records")
     )
-    return {"buildings": buildings_geojson, "fires": fires_list}
-# === END PATCH ============================================================
 
-# ------------------ 保存地图 ------------------
-m.save(OUT_HTML)
-print(f"\n✅ 地图已生成：{OUT_HTML}")
\ No newline at end of file
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    ap = argparse.ArgumentParser(description="构建火点/建筑产物并生成地图")
+    ap.add_argument("--force", action="store_true", help="忽略哈希，全部重建")
+    ap.add_argument("--no-map", action="store_true", help="只构建产物，不生成 HTML")
+    ap.add_argument("--ingest", action="store_true", help="只增量摄取火点 CSV 新追加的行")
+    ap.add_argument("--fire-mode", choices=["auto", "markers", "cluster"], default="auto",
+                    help="火点渲染方式")
+    args = ap.parse_args()
+    if args.ingest:
+        import firms
+        new, rejected = firms.ingest(FIRE_CSV)
+        print(f"新增火点：{len(new)}，剔除无效行：{rejected}")
+        sys.exit(0)
+    try:
+        rebuilt = build_artifacts(force=args.force)
+    except Exception as e:
+        print(f"产物构建失败: {str(e)}")
+        sys.exit(1)
+    print(f"重建阶段：{', '.join(rebuilt) or '无（输入未变化）'}")
+    if not args.no_map:
+        render_map(get_fire_df(), get_bldg_gdf(), fire_mode=args.fire_mode)
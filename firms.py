@@ -0,0 +1,146 @@
+# firms.py – append-only FIRMS ingest into a persistent fire store
+# FIRMS exports only grow during an incident, so each run remembers how far
+# into the CSV it got (byte offset of the last complete line) and parses only
+# what was appended since. Rows are deduplicated on
+# (latitude, longitude, acq_date, acq_time, satellite) by a unique index, so a
+# re-read overlap or a re-downloaded file never creates duplicates.
+# If the file was replaced/rewritten (shorter, or its head changed) the whole
+# file is re-read and the unique index absorbs the overlap.
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+from fire import ARTIFACT_DIR, FIRE_CSV, FIRMS_CHUNK_ROWS, iter_fire_batches
+
+STORE_DB = ARTIFACT_DIR / "firms.db"
+FIRE_DEDUP_KEY = ["latitude", "longitude", "acq_date", "acq_time", "satellite"]
+HEAD_BYTES = 64 * 1024        # prefix hashed to detect a replaced file
+
+_lock = threading.Lock()
+
+def get_store(path=STORE_DB):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS watermarks (
+           path TEXT PRIMARY KEY,
+           offset INTEGER NOT NULL,
+           head_sha1 TEXT NOT NULL
+        )"""
+    )
+    return conn
+
+def _has_fires(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fires'").fetchone() is not None
+
+def _dedup_key(columns):
+    key = [c for c in FIRE_DEDUP_KEY if c in columns]
+    if "acq_date" not in key or "acq_time" not in key:
+        key.append("datetime")    # non-FIRMS exports: fall back to the timestamp
+    return key
+
+def _head_sha1(path, n):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(min(n, HEAD_BYTES))).hexdigest()
+
+def _last_line_end(f, size):
+    """Offset just past the last '\\n' (the file may end in a half-written row)."""
+    pos = size
+    while pos > 0:
+        step = min(64 * 1024, pos)
+        f.seek(pos - step)
+        i = f.read(step).rfind(b"\n")
+        if i >= 0:
+            return pos - step + i + 1
+        pos -= step
+    return 0
+
+class _ByteRange(io.RawIOBase):
+    """Header line followed by bytes [start, end) of a file, for read_csv."""
+    def __init__(self, f, header, start, end):
+        self._f, self._head, self._end = f, header, end
+        f.seek(start)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._head:
+            n = min(len(b), len(self._head))
+            b[:n], self._head = self._head[:n], self._head[n:]
+            return n
+        data = self._f.read(max(0, min(len(b), self._end - self._f.tell())))
+        b[:len(data)] = data
+        return len(data)
+
+def _insert(conn, batch):
+    """INSERT OR IGNORE one cleaned batch; returns the rows actually added."""
+    batch.to_sql("staging", conn, if_exists="replace", index=False)
+    if not _has_fires(conn):
+        conn.execute("CREATE TABLE fires AS SELECT * FROM staging WHERE 0")
+        cols = ", ".join(f'IFNULL("{c}", \'\')' for c in _dedup_key(batch.columns))
+        conn.execute(f"CREATE UNIQUE INDEX fires_dedup ON fires ({cols})")
+    known = {r[1] for r in conn.execute("PRAGMA table_info(fires)")}
+    for c in batch.columns:
+        if c not in known:        # export gained a column
+            conn.execute(f'ALTER TABLE fires ADD COLUMN "{c}"')
+    cols = ", ".join(f'"{c}"' for c in batch.columns)
+    before = conn.execute("SELECT IFNULL(MAX(rowid), 0) FROM fires").fetchone()[0]
+    conn.execute(f"INSERT OR IGNORE INTO fires ({cols}) SELECT {cols} FROM staging")
+    conn.execute("DROP TABLE staging")
+    return before
+
+def ingest(path=FIRE_CSV, chunksize=FIRMS_CHUNK_ROWS):
+    """
+    Parse the rows appended to `path` since the last call and add them to the
+    store. Returns (new rows as a DataFrame, rejected row count).
+    """
+    key = os.path.abspath(path)
+    with _lock:
+        conn = get_store()
+        try:
+            row = conn.execute(
+                "SELECT offset, head_sha1 FROM watermarks WHERE path = ?", (key,)).fetchone()
+            size = os.path.getsize(path)
+            offset = 0
+            if row and row[0] <= size and _head_sha1(path, row[0]) == row[1]:
+                offset = row[0]
+
+            with open(path, "rb") as f:
+                header = f.readline()
+                start = max(offset, len(header))
+                end = _last_line_end(f, size)
+                if end <= start:
+                    return pd.DataFrame(), 0
+                src = io.BufferedReader(_ByteRange(f, header, start, end))
+                first, rejected = None, 0
+                with conn:
+                    for batch, bad in iter_fire_batches(src, chunksize=chunksize):
+                        rejected += bad
+                        mark = _insert(conn, batch)
+                        first = mark if first is None else first
+                    conn.execute(
+                        "INSERT OR REPLACE INTO watermarks (path, offset, head_sha1) VALUES (?, ?, ?)",
+                        (key, end, _head_sha1(path, end)))
+            if first is None:
+                return pd.DataFrame(), rejected
+            return _read(conn, "WHERE rowid > ?", (first,)), rejected
+        finally:
+            conn.close()
+
+def _read(conn, where="", params=()):
+    return pd.read_sql_query(f"SELECT * FROM fires {where} ORDER BY rowid", conn,
+                             params=params, parse_dates=["datetime"])
+
+def load_fires():
+    """Every stored fire, in ingest order."""
+    conn = get_store()
+    try:
+        return _read(conn) if _has_fires(conn) else pd.DataFrame()
+    finally:
+        conn.close()
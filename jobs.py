@@ -0,0 +1,197 @@
+# jobs.py – persistent background job queue
+# Jobs live in data/jobs.db and run on a small thread pool, so request
+# handlers can hand slow side effects (notifications, vehicle allocation) off
+# and reply immediately. A job with a coalescing key that is still queued
+# absorbs later submissions with the same key instead of running twice.
+# A job is claimed with a conditional UPDATE that stamps the claiming
+# process (owner) and a lease; a heartbeat renews the leases of the jobs a
+# process is running. Only jobs whose lease lapsed (their process died) are
+# re-queued, so several processes can share the same jobs.db without running
+# a job twice.
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from core import JOBS_DB, get_db_connection
+
+JOB_WORKERS = 4
+JOB_KEEP_DONE = 10000         # finished jobs kept for /api/jobs/<id>
+JOB_LEASE_S = 60              # a running job whose lease lapsed is presumed dead
+
+_handlers = {}                # kind -> fn(payload) -> JSON-serialisable result
+_pool = None
+_owner = None                 # host:pid:nonce of this process once started
+_start_lock = threading.Lock()
+
+def handler(kind):
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+def _init_table():
+    conn = get_db_connection(JOBS_DB)
+    conn.executescript(
+        """CREATE TABLE IF NOT EXISTS jobs (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           kind TEXT NOT NULL,
+           key TEXT,
+           payload TEXT NOT NULL,
+           status TEXT NOT NULL DEFAULT 'queued',
+           result TEXT,
+           error TEXT,
+           submissions INTEGER NOT NULL DEFAULT 1,
+           owner TEXT,
+           lease_expires REAL,
+           created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+           updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+        );
+        CREATE INDEX IF NOT EXISTS jobs_queued_key ON jobs (key) WHERE status = 'queued';
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);"""
+    )
+    known = {r[1] for r in conn.execute("PRAGMA table_info(jobs)")}
+    for col, decl in (("owner", "TEXT"), ("lease_expires", "REAL")):
+        if col not in known:      # jobs.db created before leases existed
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {col} {decl}")
+    conn.commit()
+    conn.close()
+
+# Running jobs whose owner stopped renewing the lease go back to the queue
+def _requeue_expired():
+    conn = get_db_connection(JOBS_DB)
+    with conn:
+        ids = [r[0] for r in conn.execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL, lease_expires = NULL "
+            "WHERE status = 'running' AND (lease_expires IS NULL OR lease_expires < ?) "
+            "RETURNING id", (time.time(),)).fetchall()]
+    conn.close()
+    return ids
+
+def _heartbeat():
+    while True:
+        time.sleep(JOB_LEASE_S / 3)
+        try:
+            conn = get_db_connection(JOBS_DB)
+            conn.execute("UPDATE jobs SET lease_expires = ? WHERE owner = ? AND status = 'running'",
+                         (time.time() + JOB_LEASE_S, _owner))
+            conn.commit()
+            conn.close()
+            for job_id in _requeue_expired():
+                _pool.submit(_run, job_id)
+        except sqlite3.Error as e:
+            print(f"[jobs] heartbeat failed: {e!r}")
+
+# Start the worker pool + heartbeat once; pick up queued and orphaned jobs
+def _ensure_started():
+    global _pool, _owner
+    if _pool is not None:
+        return _pool
+    with _start_lock:
+        if _pool is None:
+            _owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            _init_table()
+            _requeue_expired()
+            conn = get_db_connection(JOBS_DB)
+            pending = [r["id"] for r in conn.execute("SELECT id FROM jobs WHERE status = 'queued'")]
+            conn.close()
+            pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+            for job_id in pending:
+                pool.submit(_run, job_id)
+            _pool = pool
+            threading.Thread(target=_heartbeat, name="job-heartbeat", daemon=True).start()
+    return _pool
+
+def submit(kind, payload, key=None, merge=None):
+    """
+    Queue a job, or fold it into a still-queued job with the same key; returns
+    its id. merge(queued_payload, payload) builds the combined payload
+    (default: the newer payload replaces the queued one).
+    """
+    if kind not in _handlers:
+        raise ValueError(f"no handler for job kind {kind!r}")
+    pool = _ensure_started()
+    conn = get_db_connection(JOBS_DB)
+    try:
+        # the write lock keeps a worker from claiming the job while we merge into it
+        conn.execute("BEGIN IMMEDIATE")
+        row = None
+        if key is not None:
+            row = conn.execute(
+                "SELECT id, payload FROM jobs WHERE key = ? AND status = 'queued'", (key,)
+            ).fetchone()
+        if row:
+            job_id = row["id"]
+            if merge is not None:
+                payload = merge(json.loads(row["payload"]), payload)
+            conn.execute(
+                "UPDATE jobs SET payload = ?, submissions = submissions + 1, "
+                "updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE id = ?",
+                (json.dumps(payload), job_id))
+        else:
+            job_id = conn.execute(
+                "INSERT INTO jobs (kind, key, payload) VALUES (?, ?, ?)",
+                (kind, key, json.dumps(payload))).lastrowid
+        conn.commit()
+    finally:
+        conn.close()
+    if not row:
+        pool.submit(_run, job_id)
+    return job_id
+
+def _finish(job_id, status, result=None, error=None):
+    conn = get_db_connection(JOBS_DB)
+    # a job whose lease lapsed (and was taken over) is no longer ours to finish
+    conn.execute(
+        "UPDATE jobs SET status = ?, result = ?, error = ?, lease_expires = NULL, "
+        "updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE id = ? AND owner = ?",
+        (status, result, error, job_id, _owner))
+    conn.commit()
+    conn.close()
+
+def _run(job_id):
+    conn = get_db_connection(JOBS_DB)
+    with conn:
+        claimed = conn.execute(
+            "UPDATE jobs SET status = 'running', owner = ?, lease_expires = ?, "
+            "updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') "
+            "WHERE id = ? AND status = 'queued'",
+            (_owner, time.time() + JOB_LEASE_S, job_id)).rowcount
+        row = conn.execute("SELECT kind, payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    if not claimed:
+        return                    # another worker/process got it
+    try:
+        result = _handlers[row["kind"]](json.loads(row["payload"]))
+    except Exception as e:
+        print(f"[jobs] job {job_id} ({row['kind']}) failed: {e!r}")
+        _finish(job_id, "failed", error=repr(e))
+    else:
+        _finish(job_id, "done", result=json.dumps(result))
+    if job_id % 500 == 0:
+        _prune()
+
+def _prune():
+    conn = get_db_connection(JOBS_DB)
+    conn.execute(
+        "DELETE FROM jobs WHERE status IN ('done', 'failed') AND id <= "
+        "(SELECT IFNULL(MAX(id), 0) FROM jobs) - ?", (JOB_KEEP_DONE,))
+    conn.commit()
+    conn.close()
+
+def get_job(job_id):
+    _ensure_started()
+    conn = get_db_connection(JOBS_DB)
+    row = conn.execute(
+        "SELECT id, kind, key, status, result, error, submissions, created_at, updated_at "
+        "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+    return job
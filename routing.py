@@ -0,0 +1,480 @@
+# routing.py – CSR road graph + A* shortest paths (networkx kept as fallback)
+import heapq
+import math
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import networkx as nx
+from shapely.geometry import MultiLineString, MultiPoint
+
+import core
+
+EARTH_R_M = 6_371_000.0
+ROUTE_CACHE_SIZE = 4096       # cached (source, target) pairs
+ROUTE_CACHE_TTL_S = 600       # seconds before a cached route is recomputed
+CLOSURE_SNAP_K = 8            # nearest nodes whose edges a closure may snap to
+CLOSED_WEIGHT = math.inf      # weight of a closed edge (finite = penalty only)
+MATRIX_POOL_MIN_SOURCES = 64  # unique sources before route_matrix uses processes
+ISOCHRONE_CACHE_SIZE = 256    # cached (node, budget) reachability results
+
+# Per-slot Python lists over core's CSR arrays
+# The heap loop below indexes them element by element, which is much faster
+# on lists than on NumPy arrays.
+_csr = None
+
+def _build_csr():
+    global _csr, _closure_stamp
+    if core.KD_IDX is None:
+        core._init_route_graph()
+    lat_r, lng_r = np.radians(core.NODE_LATLNG[:, 0]), np.radians(core.NODE_LATLNG[:, 1])
+    u, v, w = core.EDGE_UV[:, 0], core.EDGE_UV[:, 1], core.EDGE_W_BASE
+
+    # Heuristic scale: largest factor that keeps haversine a lower bound on
+    # every edge weight, so A* stays admissible (and consistent).
+    straight = _haversine_m(lat_r[u], lng_r[u], lat_r[v], lng_r[v])
+    ok = straight > 1e-3
+    h_scale = 1.0
+    if ok.any():
+        h_scale = min(1.0, float(np.min(w[ok] / straight[ok])))
+    h_scale = max(0.0, h_scale * (1 - 1e-9))
+
+    _csr = {
+        "build": core.GRAPH_BUILD,
+        "n": len(core.NODE_LATLNG),
+        "h_scale": h_scale,
+        "indptr_l": core.CSR_INDPTR.tolist(),
+        "indices_l": core.CSR_INDICES.tolist(),
+        "weights_l": core.EDGE_W[core.CSR_EDGE].tolist(),
+        "lat_l": lat_r.tolist(),
+        "lng_l": lng_r.tolist(),
+    }
+
+    # fresh arrays carry no closures: re-apply the ones in the database
+    with _closure_lock:
+        _closure_edge.clear()
+        _edge_closures.clear()
+        _closure_stamp = None
+    sync_road_closures()
+    return _csr
+
+def get_csr():
+    g = _csr
+    if g is None or g["build"] != core.GRAPH_BUILD or core.KD_IDX is None:
+        g = _build_csr()
+    return g
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_R_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+# A* over the CSR arrays; returns (path, metres) or None if unreachable
+def astar_path(s, t):
+    g = get_csr()
+    if s == t:
+        return [s], 0.0
+
+    indptr, indices, weights = g["indptr_l"], g["indices_l"], g["weights_l"]
+    lat_l, lng_l = g["lat_l"], g["lng_l"]
+    scale = g["h_scale"] * 2 * EARTH_R_M
+    t_lat, t_lng = lat_l[t], lng_l[t]
+    cos_t = math.cos(t_lat)
+    sin, cos, asin, sqrt = math.sin, math.cos, math.asin, math.sqrt
+
+    h_cache = {}
+    def h(x):
+        val = h_cache.get(x)
+        if val is None:
+            a = (sin((t_lat - lat_l[x]) / 2) ** 2
+                 + cos(lat_l[x]) * cos_t * sin((t_lng - lng_l[x]) / 2) ** 2)
+            val = scale * asin(sqrt(min(1.0, a)))
+            h_cache[x] = val
+        return val
+
+    dist = {s: 0.0}
+    prev = {}
+    closed = set()
+    heap = [(h(s), 0.0, s)]
+    push, pop = heapq.heappush, heapq.heappop
+    while heap:
+        _, d, x = pop(heap)
+        if x in closed:
+            continue
+        if x == t:
+            break
+        closed.add(x)
+        for i in range(indptr[x], indptr[x + 1]):
+            y = indices[i]
+            nd = d + weights[i]
+            if nd < dist.get(y, math.inf):
+                dist[y] = nd
+                prev[y] = x
+                push(heap, (nd + h(y), nd, y))
+    else:
+        return None
+
+    path = [t]
+    while path[-1] != s:
+        path.append(prev[path[-1]])
+    path.reverse()
+    return path, dist[t]
+
+# Road closures
+# Each closure is snapped to its nearest edge and overrides that edge's
+# weight until the closure is deleted. Only the edge's two CSR slots (and
+# its networkx twin, if built) are touched – never a graph rebuild.
+_closure_edge = {}            # closure id -> edge index
+_edge_closures = {}           # edge index -> {closure ids}
+_closure_stamp = None         # (count, max id) of road_closures last synced
+_closure_lock = threading.RLock()
+
+# Nearest edge to a point among the edges of the K nearest nodes
+def _nearest_edge(lat, lng):
+    k = min(CLOSURE_SNAP_K, len(core.NODE_LATLNG))
+    _, idx = core.KD_IDX.query([lat, lng], k=k)
+    nodes = core.KD_NODE_IDS[np.atleast_1d(idx)]
+    slots = np.concatenate([np.arange(core.CSR_INDPTR[n], core.CSR_INDPTR[n + 1])
+                            for n in nodes])
+    if not len(slots):
+        return None
+    cand = np.unique(core.CSR_EDGE[slots])
+
+    # point-to-segment distance in a local metric frame around (lat, lng)
+    kx, ky = math.cos(math.radians(lat)) * 111_320.0, 110_540.0
+    a = core.NODE_LATLNG[core.EDGE_UV[cand, 0]]
+    b = core.NODE_LATLNG[core.EDGE_UV[cand, 1]]
+    ax, ay = (a[:, 1] - lng) * kx, (a[:, 0] - lat) * ky
+    dx, dy = (b[:, 1] - lng) * kx - ax, (b[:, 0] - lat) * ky - ay
+    seg2 = dx * dx + dy * dy
+    t = np.clip(-(ax * dx + ay * dy) / np.where(seg2 > 0, seg2, 1.0), 0.0, 1.0)
+    d = np.hypot(ax + t * dx, ay + t * dy)
+    i = int(np.argmin(d))
+    return int(cand[i]) if d[i] <= core.MAX_SNAP_M else None
+
+def _set_edge_weight(e, w):
+    core.EDGE_W[e] = w
+    weights = _csr["weights_l"]
+    for slot in core.EDGE_SLOTS[e].tolist():
+        weights[slot] = w
+    u, v = core.EDGE_UV[e].tolist()
+    if core.G_ROUTE.has_edge(u, v):
+        core.G_ROUTE[u][v]["weight"] = w
+
+# Snap a closure onto the graph; returns the blocked edge index (or None)
+def apply_road_closure(cid, lat, lng):
+    return apply_road_closures([(cid, lat, lng)])[0]
+
+# Batch form: one graph version bump (route cache flush) for the whole batch
+def apply_road_closures(closures):
+    edges, closed = [], False
+    with _closure_lock:
+        for cid, lat, lng in closures:
+            if _csr is None or cid in _closure_edge:    # not loaded yet: synced on build
+                edges.append(_closure_edge.get(cid))
+                continue
+            try:
+                lat, lng = float(lat), float(lng)
+                if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                    raise ValueError("out of range")
+            except (TypeError, ValueError) as err:      # e.g. a row stored by an older API
+                print(f"routing: skipping road closure {cid} ({lat!r}, {lng!r}): {err}")
+                edges.append(None)
+                continue
+            e = _nearest_edge(lat, lng)
+            edges.append(e)
+            if e is None:
+                continue
+            _closure_edge[cid] = e
+            ids = _edge_closures.setdefault(e, set())
+            ids.add(cid)
+            if len(ids) == 1:
+                _set_edge_weight(e, CLOSED_WEIGHT)
+                closed = True
+        if closed:
+            core.bump_graph_version()
+    return edges
+
+def remove_road_closure(cid):
+    with _closure_lock:
+        e = _closure_edge.pop(cid, None)
+        if e is None:
+            return
+        ids = _edge_closures[e]
+        ids.discard(cid)
+        if not ids:
+            del _edge_closures[e]
+            _set_edge_weight(e, float(core.EDGE_W_BASE[e]))
+            core.bump_graph_version()
+
+# Reconcile with road_closures.db (closures written by other workers).
+# The (count, max id) stamp changes on every insert/delete thanks to
+# AUTOINCREMENT, so the steady state costs one tiny query.
+def sync_road_closures():
+    global _closure_stamp
+    if _csr is None:
+        return
+    conn = core.get_db_connection(core.ROAD_CLOSURE_DB)
+    stamp = tuple(conn.execute("SELECT COUNT(*), MAX(id) FROM road_closures").fetchone())
+    if stamp == _closure_stamp:
+        conn.close()
+        return
+    rows = conn.execute("SELECT id, latitude, longitude FROM road_closures").fetchall()
+    conn.close()
+    with _closure_lock:
+        live = {r["id"]: r for r in rows}
+        for cid in [c for c in _closure_edge if c not in live]:
+            remove_road_closure(cid)
+        apply_road_closures([(cid, r["latitude"], r["longitude"])
+                             for cid, r in live.items() if cid not in _closure_edge])
+        _closure_stamp = stamp
+
+# networkx ignores edges whose weight function returns None
+def _nx_weight(u, v, d):
+    w = d["weight"]
+    return None if math.isinf(w) else w
+
+# Single-source Dijkstra over CSR lists -> {node: metres}.
+# Stops as soon as every node in `targets` is settled, or once distances
+# exceed `limit` (targets=None settles everything within the limit).
+def sssp(indptr, indices, weights, s, targets=None, limit=math.inf):
+    remaining = set(targets) if targets is not None else None
+    dist = {s: 0.0}
+    settled = {}
+    heap = [(0.0, s)]
+    push, pop = heapq.heappush, heapq.heappop
+    while heap:
+        d, x = pop(heap)
+        if x in settled:
+            continue
+        if d > limit:
+            break
+        settled[x] = d
+        if remaining is not None:
+            remaining.discard(x)
+            if not remaining:
+                break
+        for i in range(indptr[x], indptr[x + 1]):
+            y = indices[i]
+            nd = d + weights[i]
+            if nd < dist.get(y, math.inf):
+                dist[y] = nd
+                push(heap, (nd, y))
+    return settled
+
+# Process-pool workers get their own copy of the CSR lists with base weights.
+# One pool is kept per graph build; closures change weights far more often
+# than that, so the closed slots travel with every task (tagged with the
+# graph version) and each worker patches its lists when the version moves.
+# Workers are spawned, not forked: the server runs job-queue, SSE and pool
+# threads, and a fork taken while one of them holds a lock can deadlock.
+_pool_graph = None
+_pool_base = None
+_pool_patch = (None, ())      # (graph version, patched slots) applied in this worker
+_matrix_pool = None           # (pid, graph build, executor)
+_matrix_pool_lock = threading.Lock()
+
+def _pool_init(indptr, indices, weights):
+    global _pool_graph, _pool_base
+    _pool_base = weights.tolist()
+    _pool_graph = (indptr.tolist(), indices.tolist(), list(_pool_base))
+
+def _pool_apply(overrides):
+    global _pool_patch
+    version, pairs = overrides
+    if version == _pool_patch[0]:
+        return
+    weights = _pool_graph[2]
+    for slot in _pool_patch[1]:
+        weights[slot] = _pool_base[slot]
+    for slot, w in pairs:
+        weights[slot] = w
+    _pool_patch = (version, [slot for slot, _ in pairs])
+
+def _pool_row(args):
+    s, targets, overrides = args
+    _pool_apply(overrides)
+    settled = sssp(*_pool_graph, s, targets)
+    return {t: settled[t] for t in targets if t in settled}
+
+# (graph version, ((slot, weight), ...)) for every closed edge
+def _weight_overrides(g):
+    with _closure_lock:
+        weights = g["weights_l"]
+        pairs = tuple((slot, weights[slot]) for e in _edge_closures
+                      for slot in core.EDGE_SLOTS[e].tolist())
+        return core.GRAPH_VERSION, pairs
+
+def _get_matrix_pool(g):
+    global _matrix_pool
+    key = (os.getpid(), g["build"])
+    with _matrix_pool_lock:
+        if _matrix_pool is None or _matrix_pool[:2] != key:
+            if _matrix_pool is not None and _matrix_pool[0] == key[0]:
+                _matrix_pool[2].shutdown(wait=False)     # running maps still finish
+            pool = ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_pool_init,
+                initargs=(np.asarray(g["indptr_l"]), np.asarray(g["indices_l"]),
+                          core.EDGE_W_BASE[core.CSR_EDGE]))
+            _matrix_pool = (*key, pool)
+        return _matrix_pool[2]
+
+def _drop_matrix_pool(pool):
+    global _matrix_pool
+    with _matrix_pool_lock:
+        if _matrix_pool is not None and _matrix_pool[2] is pool:
+            _matrix_pool = None
+    pool.shutdown(wait=False)
+
+# Dense metres matrix between node lists (NaN where unreachable)
+def route_matrix(src_nodes, tgt_nodes):
+    g = get_csr()
+    sync_road_closures()
+    src_nodes, tgt_nodes = list(src_nodes), list(tgt_nodes)
+    uniq_src = list(dict.fromkeys(src_nodes))
+    uniq_tgt = list(dict.fromkeys(tgt_nodes))
+
+    if len(uniq_src) >= MATRIX_POOL_MIN_SOURCES and (os.cpu_count() or 1) > 1:
+        chunk = max(1, len(uniq_src) // (4 * (os.cpu_count() or 1)))
+        overrides = _weight_overrides(g)
+        tasks = [(s, uniq_tgt, overrides) for s in uniq_src]
+        pool = _get_matrix_pool(g)
+        try:
+            rows = list(pool.map(_pool_row, tasks, chunksize=chunk))
+        except RuntimeError:        # replaced after a graph rebuild, or a worker died
+            _drop_matrix_pool(pool)
+            rows = list(_get_matrix_pool(g).map(_pool_row, tasks, chunksize=chunk))
+    else:
+        args = (g["indptr_l"], g["indices_l"], g["weights_l"])
+        rows = [sssp(*args, s, uniq_tgt) for s in uniq_src]
+
+    by_src = dict(zip(uniq_src, rows))
+    out = np.full((len(src_nodes), len(tgt_nodes)), np.nan)
+    for i, s in enumerate(src_nodes):
+        row = by_src[s]
+        out[i] = [row.get(t, np.nan) for t in tgt_nodes]
+    return out
+
+# Plain networkx Dijkstra on core.G_ROUTE (reference / fallback)
+def nx_path(s, t):
+    G = core._ensure_nx_graph()
+    try:
+        path = nx.shortest_path(G, s, t, weight=_nx_weight)
+    except nx.NetworkXNoPath:
+        return None
+    dist_m = 0.0
+    for u, v in zip(path[:-1], path[1:]):
+        dist_m += G.edges[u, v]["weight"]
+    return path, dist_m
+
+# (lon, lat) vertex list for a node path
+def path_lonlat(path):
+    return core.NODE_LATLNG[np.asarray(path, dtype=np.int64)][:, ::-1].tolist()
+
+# Bounded LRU + TTL cache whose entries are only valid for one graph version
+class VersionedLRU:
+    def __init__(self, maxsize, ttl_s):
+        self.maxsize, self.ttl_s = maxsize, ttl_s
+        self.version = None
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    # False if the caller holds an older version than the cache has seen
+    def _sync(self, version):
+        if self.version is not None and version < self.version:
+            return False
+        if version != self.version:         # graph changed: everything is stale
+            self._data.clear()
+            self.version = version
+        return True
+
+    def get(self, key, version, default=None):
+        with self._lock:
+            item = self._data.get(key) if self._sync(version) else None
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, version):
+        with self._lock:
+            if not self._sync(version):
+                return
+            self._data[key] = (time.monotonic() + self.ttl_s, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._data), "maxsize": self.maxsize,
+                    "ttl_s": self.ttl_s, "graph_version": self.version}
+
+ROUTE_CACHE = VersionedLRU(ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL_S)
+_NO_PATH = object()
+
+# Route between two snapped nodes. engine: "astar" (default) or "nx".
+def shortest_route(s, t, engine="astar"):
+    # both engines read the closure-adjusted weights, so apply closures first
+    get_csr()
+    sync_road_closures()
+    if engine == "nx":
+        return nx_path(s, t)
+
+    version = core.GRAPH_VERSION
+    found = ROUTE_CACHE.get((s, t), version)
+    if found is not None:
+        return None if found is _NO_PATH else found
+    try:
+        found = astar_path(s, t)
+    except Exception as e:          # keep serving routes if the CSR engine breaks
+        print(f"routing: A* failed ({e!r}), falling back to networkx")
+        return nx_path(s, t)
+    ROUTE_CACHE.put((s, t), _NO_PATH if found is None else found, version)
+    return found
+
+# Everything within budget_m of node s, as GeoJSON-ready geometries.
+# An edge counts as reachable when both of its endpoints are; the hull is
+# the convex hull of the reachable nodes.
+ISOCHRONE_CACHE = VersionedLRU(ISOCHRONE_CACHE_SIZE, ROUTE_CACHE_TTL_S)
+
+def isochrone(s, budget_m):
+    g = get_csr()
+    sync_road_closures()
+    version = core.GRAPH_VERSION
+    key = (s, round(float(budget_m), 1))
+    found = ISOCHRONE_CACHE.get(key, version)
+    if found is not None:
+        return found
+
+    settled = sssp(g["indptr_l"], g["indices_l"], g["weights_l"], s, limit=budget_m)
+    nodes = np.fromiter(settled.keys(), dtype=np.int64, count=len(settled))
+    dists = np.fromiter(settled.values(), dtype=float, count=len(settled))
+    inside = np.zeros(g["n"], dtype=bool)
+    inside[nodes] = True
+    edges = np.flatnonzero(inside[core.EDGE_UV[:, 0]] & inside[core.EDGE_UV[:, 1]]
+                           & np.isfinite(core.EDGE_W))
+
+    lonlat = core.NODE_LATLNG[:, ::-1]
+    lines = MultiLineString(lonlat[core.EDGE_UV[edges]].tolist())
+    hull = MultiPoint(lonlat[nodes].tolist()).convex_hull
+    found = {
+        "node": int(s),
+        "reachable_nodes": int(len(nodes)),
+        "reachable_edges": int(len(edges)),
+        "max_km": round(float(dists.max()) / 1000.0, 3),
+        "edges": lines.__geo_interface__,
+        "hull": hull.__geo_interface__,
+    }
+    ISOCHRONE_CACHE.put(key, found, version)
+    return found
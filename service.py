@@ -1,55 +1,59 @@
 # service.py – wildfire helpers
 # Contains helper functions that the Flask API calls.
-from core import get_db_connection, haversine_distance, USER_DB, VEHICLE_DB
+import numpy as np
+import events
+import jobs
+from core import rows_near_points, rows_within_radius, users_within_radius
+
+NOTIFY_RADIUS_KM = 30
+ALLOCATE_MAX_KM = 50
+ALLOCATE_CAPACITY = 10
 
 # User notification
 # Return usernames within radius_km km of the fire location.
-def notify_users_nearby(fire_lat, fire_lng, radius_km=30):
-    conn = get_db_connection(USER_DB)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT username, latitude, longitude FROM users WHERE latitude IS NOT NULL AND longitude IS NOT NULL"""
-    )
-    users = cursor.fetchall()
-    conn.close()
-
-    nearby_users = []
-    for user in users:
-        distance = haversine_distance(fire_lat, fire_lng, user["latitude"], user["longitude"])
-        if distance <= radius_km:
-            nearby_users.append(user["username"])
-    return nearby_users
+def notify_users_nearby(fire_lat, fire_lng, radius_km=NOTIFY_RADIUS_KM):
+    return users_within_radius(fire_lat, fire_lng, radius_km)
 
 # Vehicle allocation
-# Pick nearest vehicles until requested capacity is reached.
-def allocate_vehicles_for_fire(fire_lat, fire_lng, capacity=10):
-    conn = get_db_connection(VEHICLE_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, latitude, longitude, capacity, vehicle_type FROM vehicles")
-    vehicles = cursor.fetchall()
-    conn.close()
+# Pick nearest vehicles within max_km until required_capacity is reached.
+# Candidates come from the vehicles R*Tree, so only vehicles near the fire
+# are read from SQLite.
+def allocate_nearest_vehicles(fire_lat, fire_lng, required_capacity=ALLOCATE_CAPACITY,
+                              vehicle_type=None, max_km=ALLOCATE_MAX_KM):
+    rows = []
+    if required_capacity > 0:
+        rows, _ = rows_within_radius(
+            "vehicles", fire_lat, fire_lng, max_km,
+            "t.id, t.capacity, t.vehicle_type",
+            "t.vehicle_type = ?" if vehicle_type else "",
+            (vehicle_type,) if vehicle_type else ())
+    return _allocate_from(rows, required_capacity)
 
-    vehicles_sorted = sorted(
-        vehicles,
-        key=lambda v: haversine_distance(fire_lat, fire_lng, v["latitude"], v["longitude"])
-    )
+# Allocation result from candidate vehicle rows sorted nearest first
+def _allocate_from(rows, required_capacity):
+    ids = np.array([r["id"] for r in rows], dtype=np.int64)
+    lats = np.array([r["latitude"] for r in rows], dtype=float)
+    lngs = np.array([r["longitude"] for r in rows], dtype=float)
+    caps = np.array([r["capacity"] for r in rows], dtype=np.int64)
+    types = np.array([r["vehicle_type"] for r in rows], dtype=object)
 
-    allocated_vehicles = []
-    total_capacity_overall = 0
+    # rows are nearest first: stop at the first prefix that covers the demand
+    order = np.empty(0, dtype=np.int64)
+    if len(rows):
+        cum = np.cumsum(caps)
+        order = np.arange(min(len(rows), int(np.searchsorted(cum, required_capacity)) + 1))
 
-    for v in vehicles_sorted:
-        dist_km = haversine_distance(fire_lat, fire_lng, v["latitude"], v["longitude"])
-        if dist_km <= 50 and total_capacity_overall < capacity:
-            allocated_vehicles.append({
-                "id": v["id"],
-                "latitude": v["latitude"],
-                "longitude": v["longitude"],
-                "capacity": v["capacity"],
-                "vehicle_type": v["vehicle_type"]
-            })
-            total_capacity_overall += v["capacity"]
-            if total_capacity_overall >= capacity:
-                break
+    allocated_vehicles = [
+        {
+            "id": int(ids[i]),
+            "latitude": float(lats[i]),
+            "longitude": float(lngs[i]),
+            "capacity": int(caps[i]),
+            "vehicle_type": types[i]
+        }
+        for i in order
+    ]
+    total_capacity_overall = sum(v["capacity"] for v in allocated_vehicles)
 
     # Summarize by vehicle type
     type_summary = {}
@@ -64,4 +68,69 @@ def allocate_vehicles_for_fire(fire_lat, fire_lng, capacity=10):
         "allocated_vehicles": allocated_vehicles,
         "total_capacity_overall": total_capacity_overall,
         "type_summary": type_summary
-    }
\ No newline at end of file
+    }
+
+def allocate_vehicles_for_fire(fire_lat, fire_lng, capacity=ALLOCATE_CAPACITY):
+    return allocate_nearest_vehicles(fire_lat, fire_lng, required_capacity=capacity)
+
+def _fire_response(lat, lng):
+    return {
+        "notified_users": notify_users_nearby(lat, lng),
+        "allocated_vehicles": allocate_vehicles_for_fire(lat, lng),
+    }
+
+# Compact allocation event for /api/stream (counts and ids only, no usernames)
+def _allocation_event(fire, result):
+    alloc = result["allocated_vehicles"]
+    return ({
+        "fire_id": fire["fire_id"],
+        "vehicle_ids": [v["id"] for v in alloc["allocated_vehicles"]],
+        "total_capacity": alloc["total_capacity_overall"],
+        "notified_users": len(result["notified_users"]),
+    }, fire["latitude"], fire["longitude"])
+
+# Background side effects of a newly reported fire (queued by add_fire);
+# repeated reports of the same fire are merged into one job's fire_ids
+@jobs.handler("fire_response")
+def fire_response_job(payload):
+    fire_ids = payload.get("fire_ids") or [payload["fire_id"]]
+    result = {"fire_ids": fire_ids,
+              **_fire_response(payload["latitude"], payload["longitude"])}
+    events.publish_many("allocation", [_allocation_event({**payload, "fire_id": fid}, result)
+                                       for fid in fire_ids])
+    return result
+
+# One job for a whole bulk upload (queued by add_fires). Users and vehicles
+# near the batch are read with one R*Tree query each; fires are then served
+# in order, each taking its nearest vehicles that no earlier fire of the
+# batch was given. Fires reported at the same coordinates share one result.
+@jobs.handler("fire_response_batch")
+def fire_response_batch_job(payload):
+    fires = payload["fires"]
+    spots = list(dict.fromkeys((f["latitude"], f["longitude"]) for f in fires))
+    lats = [la for la, _ in spots]
+    lngs = [ln for _, ln in spots]
+    users, near_users = rows_near_points("users", lats, lngs, NOTIFY_RADIUS_KM, "t.username")
+    vehicles, near_vehicles = rows_near_points(
+        "vehicles", lats, lngs, ALLOCATE_MAX_KM, "t.id, t.capacity, t.vehicle_type")
+
+    taken = set()
+    done = {}
+    for spot, (u_idx, _), (v_idx, _) in zip(spots, near_users, near_vehicles):
+        chosen, capacity = [], 0
+        for i in v_idx.tolist():          # nearest free vehicles until the demand is covered
+            if capacity >= ALLOCATE_CAPACITY:
+                break
+            if i not in taken:
+                chosen.append(i)
+                capacity += vehicles[i]["capacity"]
+        taken.update(chosen)
+        alloc = _allocate_from([vehicles[i] for i in chosen], ALLOCATE_CAPACITY)
+        done[spot] = {"notified_users": [users[i]["username"] for i in u_idx.tolist()],
+                      "allocated_vehicles": alloc}
+
+    results = [{"fire_id": f["fire_id"], **done[(f["latitude"], f["longitude"])]}
+               for f in fires]
+    events.publish_many("allocation", [_allocation_event(f, r)
+                                       for f, r in zip(fires, results)])
+    return {"fires": results}
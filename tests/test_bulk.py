@@ -0,0 +1,76 @@
+# Bulk upload validation: invalid rows are rejected and reported, valid rows inserted.
+import sqlite3
+
+import pytest
+from flask import Flask
+
+import api
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    db = str(tmp_path / "vehicles.db")
+    conn = sqlite3.connect(db)
+    conn.execute("""CREATE TABLE vehicles (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    latitude REAL NOT NULL, longitude REAL NOT NULL,
+                    capacity INTEGER NOT NULL, vehicle_type TEXT NOT NULL)""")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(api, "VEHICLE_DB", db)
+    app = Flask(__name__)
+    app.register_blueprint(api.api_bp)
+    yield app.test_client(), db
+
+
+def _capacities(db):
+    conn = sqlite3.connect(db)
+    caps = [r[0] for r in conn.execute("SELECT capacity FROM vehicles ORDER BY id")]
+    conn.close()
+    return caps
+
+
+def test_add_vehicles_rejects_out_of_range_capacity(client):
+    c, db = client
+    rows = [
+        {"latitude": 34.0, "longitude": -118.0, "capacity": 4},
+        {"latitude": 34.0, "longitude": -118.0, "capacity": 1e30},
+        {"latitude": 34.0, "longitude": -118.0, "capacity": api.VEHICLE_MAX_CAPACITY + 1},
+        {"latitude": 34.0, "longitude": -118.0, "capacity": -5},
+        {"latitude": 34.0, "longitude": -118.0, "capacity": 2.5},
+        {"latitude": 34.0, "longitude": -118.0, "capacity": api.VEHICLE_MAX_CAPACITY},
+    ]
+    r = c.post("/api/add_vehicles", json=rows)
+    assert r.status_code == 201
+    body = r.get_json()
+    assert len(body["vehicle_ids"]) == 2
+    assert body["rejected"] == 4
+    assert [e["row"] for e in body["errors"]] == [1, 2, 3, 4]
+    assert all("capacity" in e["error"] for e in body["errors"])
+    assert _capacities(db) == [4, api.VEHICLE_MAX_CAPACITY]
+
+
+def test_add_vehicles_reports_bad_rows_from_csv(client):
+    c, db = client
+    csv = ("latitude,longitude,capacity,vehicle_type\n"
+           "34.1,-118.2,6,truck\n"
+           "abc,-118.2,6,truck\n"
+           "34.1,-200,6,\n"
+           "34.2,-118.3,3,\n")
+    r = c.post("/api/add_vehicles", data=csv, content_type="text/csv")
+    body = r.get_json()
+    assert r.status_code == 201
+    assert body["rejected"] == 2
+    assert body["errors"] == [
+        {"row": 1, "error": "latitude must be a number in [-90.0, 90.0]"},
+        {"row": 2, "error": "longitude must be a number in [-180.0, 180.0]"},
+    ]
+    assert _capacities(db) == [6, 3]
+
+
+def test_add_vehicles_all_invalid(client):
+    c, db = client
+    r = c.post("/api/add_vehicles", json=[{"latitude": 1, "longitude": 1, "capacity": 0}])
+    assert r.status_code == 400
+    assert r.get_json()["rejected"] == 1
+    assert _capacities(db) == []
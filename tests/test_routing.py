@@ -0,0 +1,152 @@
+# A* on the CSR arrays must agree with networkx Dijkstra, with and without
+# road closures, on a small synthetic road grid.
+import random
+import sqlite3
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import LineString
+
+import core
+import routing
+
+GRID = 12
+
+
+def _write_grid(path, seed=0):
+    rng = random.Random(seed)
+    pts = {(i, j): (-118.40 + j * 0.01 + rng.uniform(-0.003, 0.003),
+                    34.00 + i * 0.008 + rng.uniform(-0.002, 0.002))
+           for i in range(GRID) for j in range(GRID)}
+    lines = []
+    for (i, j), p in pts.items():
+        for di, dj in ((0, 1), (1, 0), (1, 1)):
+            q = pts.get((i + di, j + dj))
+            if q and rng.random() < 0.8:
+                mid = ((p[0] + q[0]) / 2 + rng.uniform(-0.001, 0.001), (p[1] + q[1]) / 2)
+                lines.append(LineString([p, mid, q]))
+    gpd.GeoDataFrame(geometry=lines, crs=4326).to_file(path, driver="GeoJSON")
+
+
+@pytest.fixture
+def graph(tmp_path, monkeypatch):
+    edges = tmp_path / "edges.geojson"
+    _write_grid(edges)
+    closures_db = str(tmp_path / "road_closures.db")
+    conn = sqlite3.connect(closures_db)
+    conn.execute("""CREATE TABLE road_closures (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    latitude REAL NOT NULL, longitude REAL NOT NULL, reason TEXT)""")
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(core, "EDGES_FILE", edges)
+    monkeypatch.setattr(core, "ROAD_CLOSURE_DB", closures_db)
+    monkeypatch.setattr(core, "ROUTE_CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(core, "KD_IDX", None)
+    monkeypatch.setattr(routing, "_csr", None)
+    monkeypatch.setattr(routing, "_closure_stamp", None)
+    routing._closure_edge.clear()
+    routing._edge_closures.clear()
+    core._graph_edges.cache_clear()
+    yield routing.get_csr()
+    core._graph_edges.cache_clear()
+    core.G_ROUTE.clear()
+
+
+def _close(lat, lng):
+    conn = sqlite3.connect(core.ROAD_CLOSURE_DB)
+    conn.execute("INSERT INTO road_closures (latitude, longitude) VALUES (?, ?)", (lat, lng))
+    conn.commit()
+    conn.close()
+
+
+def _assert_engines_agree(pairs):
+    for s, t in pairs:
+        a = routing.shortest_route(s, t)
+        b = routing.shortest_route(s, t, engine="nx")
+        assert (a is None) == (b is None), (s, t)
+        if a is not None:
+            assert a[1] == pytest.approx(b[1], abs=1e-6), (s, t)
+
+
+def _random_pairs(n_nodes, n_pairs=150, seed=0):
+    rng = random.Random(seed)
+    return [(rng.randrange(n_nodes), rng.randrange(n_nodes)) for _ in range(n_pairs)]
+
+
+def test_astar_matches_networkx(graph):
+    _assert_engines_agree(_random_pairs(graph["n"]))
+
+
+def test_astar_matches_networkx_with_closures(graph):
+    s, t = 0, graph["n"] - 1
+    path, before = routing.shortest_route(s, t)
+
+    # close three edges along the current best route
+    for u, v in list(zip(path[:-1], path[1:]))[1:-1:max(1, len(path) // 4)][:3]:
+        lat, lng = (core.NODE_LATLNG[u] + core.NODE_LATLNG[v]) / 2
+        _close(lat, lng)
+    _assert_engines_agree([(s, t)] + _random_pairs(graph["n"], seed=1))
+
+    found = routing.shortest_route(s, t)
+    assert found is not None and found[1] > before
+    closed = set(routing._closure_edge.values())
+    uv = {tuple(sorted(e)): i for i, e in enumerate(core.EDGE_UV.tolist())}
+    assert not closed & {uv[tuple(sorted(e))] for e in zip(found[0][:-1], found[0][1:])}
+
+
+def test_fully_closed_node_is_unreachable(graph):
+    s = int(core.EDGE_UV[0, 0])
+    for e in range(len(core.EDGE_UV)):
+        if s in core.EDGE_UV[e]:
+            u, v = core.EDGE_UV[e]
+            lat, lng = (core.NODE_LATLNG[u] + core.NODE_LATLNG[v]) / 2
+            _close(lat, lng)
+    t = graph["n"] - 1 if s != graph["n"] - 1 else 0
+    assert routing.shortest_route(s, t) is None
+    assert routing.shortest_route(s, t, engine="nx") is None
+
+
+def test_route_matrix_pool_matches_serial(graph, monkeypatch):
+    monkeypatch.setattr(routing.os, "cpu_count", lambda: 2)
+    src = list(range(routing.MATRIX_POOL_MIN_SOURCES))
+    tgt = list(range(0, graph["n"], 7))
+
+    def serial():
+        g = routing.get_csr()
+        routing.sync_road_closures()
+        args = (g["indptr_l"], g["indices_l"], g["weights_l"])
+        rows = [routing.sssp(*args, s, tgt) for s in src]
+        return [[row.get(t, float("nan")) for t in tgt] for row in rows]
+
+    try:
+        pooled = routing.route_matrix(src, tgt)
+        pool = routing._matrix_pool[2]
+        np.testing.assert_allclose(pooled, serial())
+        routing.route_matrix(src, tgt)
+        assert routing._matrix_pool[2] is pool          # reused while the graph is unchanged
+
+        u, v = core.EDGE_UV[0]
+        _close(*(core.NODE_LATLNG[u] + core.NODE_LATLNG[v]) / 2)
+        pooled = routing.route_matrix(src, tgt)
+        assert routing._matrix_pool[2] is pool          # closures travel with the tasks
+        np.testing.assert_allclose(pooled, serial())
+
+        routing.remove_road_closure(max(routing._closure_edge))
+        np.testing.assert_allclose(routing.route_matrix(src, tgt), serial())
+    finally:
+        if routing._matrix_pool is not None:
+            routing._matrix_pool[2].shutdown()
+        routing._matrix_pool = None
+
+
+def test_unparsable_closure_row_is_skipped(graph):
+    _close("abc", "def")
+    u, v = core.EDGE_UV[0]
+    _close(*(core.NODE_LATLNG[u] + core.NODE_LATLNG[v]) / 2)
+    routing.sync_road_closures()
+    assert set(routing._closure_edge.values()) == {0}
+    routing._csr = None
+    assert routing.get_csr()["n"] == graph["n"]
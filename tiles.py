@@ -0,0 +1,198 @@
+# tiles.py – tiled GeoJSON for the map layers: /tiles/<layer>/<z>/<x>/<y>
+# Tiles are simplified per zoom, clipped to a slightly buffered tile box and
+# kept gzip-compressed in a bounded memory LRU plus an on-disk cache, so the
+# browser/proxies can cache them (every URL is stable, unlike free bboxes).
+#
+# Pre-seed offline:  python tiles.py seed mesh edges --zooms 8-14
+import argparse
+import gzip
+import hashlib
+import math
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+import shapely
+from flask import Blueprint, Response, jsonify, request
+
+import core
+from routing import VersionedLRU
+
+TILE_DIR = Path("outputs/tiles")
+TILE_PX = 256                 # nominal tile size used for the simplify tolerance
+TILE_BUFFER_PX = 8            # clip box overlap so lines don't gap at tile seams
+SIMPLIFY_PX = 0.5             # tolerance in pixels at the tile's zoom
+TILE_MEM_TILES = 2048         # tiles kept in memory
+TILE_DISK_MAX_MB = 512        # on-disk cache budget (oldest tiles pruned)
+TILE_TTL_S = 24 * 3600
+TILE_MAX_AGE_S = 3600         # Cache-Control max-age sent to clients
+
+# layer -> (GeoDataFrame loader, source files for the version stamp, min zoom)
+TILE_LAYERS = {
+    "mesh":      (core._mesh_gdf,     lambda: [core.MESH_FILE], 6),
+    "edges":     (core._graph_edges,  lambda: [core.EDGES_FILE], 10),
+    "nodes":     (core._graph_nodes,  lambda: [core.NODES_FILE], 13),
+    "buildings": (core._buildings_gdf, lambda: [Path(f) for f in _building_sources()], 13),
+}
+
+def _building_sources():
+    import fire
+    fire.build_artifacts(stages=["buildings"])
+    return [fire.BLDG_ARTIFACT]
+
+tiles_bp = Blueprint("tiles", __name__)
+_mem = VersionedLRU(TILE_MEM_TILES, TILE_TTL_S)
+_disk_lock = threading.Lock()
+_disk_writes = 0
+
+# Cheap content stamp for a layer: size + mtime of its source files
+@lru_cache(maxsize=None)
+def _layer_stamp(layer):
+    h = hashlib.sha1()
+    for p in TILE_LAYERS[layer][1]():
+        st = os.stat(p)
+        h.update(f"{p}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()[:12]
+
+@lru_cache(maxsize=None)
+def _layer_data(layer):
+    gdf = TILE_LAYERS[layer][0]()
+    return gdf, gdf.sindex
+
+# Web‑Mercator tile -> lon/lat bounds
+def tile_bounds(z, x, y):
+    n = 2 ** z
+    lon0, lon1 = x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+    lat1 = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    lat0 = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return lon0, lat0, lon1, lat1
+
+def tiles_covering(bounds, z):
+    lon0, lat0, lon1, lat1 = bounds
+    n = 2 ** z
+    def _xy(lon, lat):
+        lat = max(min(lat, 85.0511), -85.0511)
+        x = int((lon + 180.0) / 360.0 * n)
+        y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+    x0, y0 = _xy(lon0, lat1)
+    x1, y1 = _xy(lon1, lat0)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+# Render one tile to gzip-compressed GeoJSON bytes
+def render_tile(layer, z, x, y):
+    gdf, sindex = _layer_data(layer)
+    lon0, lat0, lon1, lat1 = tile_bounds(z, x, y)
+    deg_px = (lon1 - lon0) / TILE_PX
+    pad = TILE_BUFFER_PX * deg_px
+    clip_box = (lon0 - pad, lat0 - pad, lon1 + pad, lat1 + pad)
+
+    empty = b'{"type":"FeatureCollection","features":[]}'
+    if z < TILE_LAYERS[layer][2]:
+        return gzip.compress(empty)
+    idx = sindex.query(shapely.box(*clip_box), predicate="intersects")
+    if not len(idx):
+        return gzip.compress(empty)
+
+    sub = gdf.iloc[sorted(idx)].copy()
+    geoms = sub.geometry.values
+    if z < 18:
+        geoms = shapely.simplify(geoms, SIMPLIFY_PX * deg_px, preserve_topology=True)
+    bad = ~shapely.is_valid(geoms)            # source layers carry some broken rings
+    if bad.any():
+        geoms = geoms.copy()
+        geoms[bad] = shapely.make_valid(geoms[bad])
+    sub.geometry = shapely.clip_by_rect(geoms, *clip_box)
+    sub = sub[~sub.geometry.is_empty]
+    return gzip.compress(sub.to_json(drop_id=False).encode(), compresslevel=6)
+
+def _disk_path(layer, stamp, z, x, y):
+    return TILE_DIR / layer / stamp / str(z) / str(x) / f"{y}.geojson.gz"
+
+def _prune_disk():
+    files = [(p.stat().st_mtime, p.stat().st_size, p) for p in TILE_DIR.rglob("*.gz")]
+    total = sum(f[1] for f in files)
+    budget = TILE_DISK_MAX_MB * 1024 * 1024
+    for _, size, p in sorted(files):
+        if total <= budget:
+            break
+        p.unlink(missing_ok=True)
+        total -= size
+
+def get_tile(layer, z, x, y):
+    stamp = _layer_stamp(layer)
+    key = (layer, stamp, z, x, y)
+    data = _mem.get(key, 0)
+    if data is not None:
+        return stamp, data
+
+    path = _disk_path(layer, stamp, z, x, y)
+    if path.exists():
+        data = path.read_bytes()
+    else:
+        global _disk_writes
+        data = render_tile(layer, z, x, y)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with _disk_lock:
+            _disk_writes += 1
+            if _disk_writes % 256 == 0:
+                _prune_disk()
+    _mem.put(key, data, 0)
+    return stamp, data
+
+@tiles_bp.route("/tiles/<layer>/<int:z>/<int:x>/<int:y>")
+def serve_tile(layer, z, x, y):
+    if layer not in TILE_LAYERS:
+        return jsonify({"error": f"unknown layer {layer}"}), 404
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({"error": "tile out of range"}), 400
+
+    stamp, data = get_tile(layer, z, x, y)
+    etag = f'"{layer}-{stamp}-{z}-{x}-{y}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={TILE_MAX_AGE_S}",
+               "Vary": "Accept-Encoding"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(data, mimetype="application/geo+json", headers=headers)
+    return Response(gzip.decompress(data), mimetype="application/geo+json", headers=headers)
+
+# Offline pre-seeding of the disk cache
+def seed(layers, zooms, bounds=None):
+    total = 0
+    for layer in layers:
+        count = 0
+        gdf, _ = _layer_data(layer)
+        b = bounds or tuple(gdf.total_bounds)
+        for z in zooms:
+            if z < TILE_LAYERS[layer][2]:
+                continue
+            for x, y in tiles_covering(b, z):
+                get_tile(layer, z, x, y)
+                count += 1
+        print(f"seeded {layer}: {count} tiles")
+        total += count
+    _prune_disk()
+    return total
+
+def _parse_zooms(text):
+    lo, _, hi = text.partition("-")
+    return range(int(lo), int(hi or lo) + 1)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Pre-seed the tile cache")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sp = sub.add_parser("seed")
+    sp.add_argument("layers", nargs="+", choices=sorted(TILE_LAYERS))
+    sp.add_argument("--zooms", default="10-14", help="e.g. 12 or 8-14")
+    sp.add_argument("--bbox", help="minlon,minlat,maxlon,maxlat (default: layer extent)")
+    args = ap.parse_args()
+    bbox = tuple(float(v) for v in args.bbox.split(",")) if args.bbox else None
+    seed(args.layers, _parse_zooms(args.zooms), bbox)
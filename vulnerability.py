@@ -0,0 +1,197 @@
+# vulnerability.py – persistent per-building vulnerability store
+# Keeps the scoring inputs (height_ft, area_sqft, fuel mean) for every building,
+# keyed by building id, in a small SQLite file next to the build artifacts.
+# A sync only runs zonal stats for buildings that are new, moved, or lie in a
+# changed part of the fuel raster, and only rescores rows whose inputs changed –
+# unless one of the normalising maxima moved, in which case every row is
+# rescaled (cheap: pure NumPy, no raster access).
+#
+# The score itself is unchanged from fire.score_buildings:
+#   0.5·h/h_max + 0.3·a/a_max + 0.2·fuel/fuel_max, clipped to [0, 1]
+import hashlib
+import os
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from fire import ARTIFACT_DIR, FUEL_TIF, compute_fuel_mean
+
+STORE_DB = ARTIFACT_DIR / "vulnerability.db"
+BLDG_ID_FIELD = "OBJECTID"    # falls back to row position when the field is missing
+
+def get_store(path=STORE_DB):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS buildings (
+           bid TEXT PRIMARY KEY,
+           geom_sha1 TEXT NOT NULL,
+           height_ft REAL NOT NULL,
+           area_sqft REAL NOT NULL,
+           fuel_mean REAL NOT NULL,
+           vulnerability REAL NOT NULL
+        )"""
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+def _meta(conn):
+    return dict(conn.execute("SELECT key, value FROM meta").fetchall())
+
+# Cheap identity of the fuel raster (path + size + mtime)
+def raster_stamp(fuel_path):
+    st = os.stat(fuel_path)
+    return f"{Path(fuel_path).resolve()}:{st.st_size}:{st.st_mtime_ns}"
+
+def building_ids(bldg_gdf):
+    if BLDG_ID_FIELD in bldg_gdf.columns:
+        return bldg_gdf[BLDG_ID_FIELD].astype(str).to_numpy()
+    return np.arange(len(bldg_gdf)).astype(str)
+
+def _geom_hashes(geoms):
+    return np.array([hashlib.sha1(b).hexdigest() for b in shapely.to_wkb(np.asarray(geoms))])
+
+def score(height, area, fuel, maxima):
+    h_max, a_max, f_max = maxima
+    fuel_n = fuel / f_max if f_max > 0 else np.zeros_like(fuel)
+    return np.clip(0.5 * (height / h_max) + 0.3 * (area / a_max) + 0.2 * fuel_n, 0, 1)
+
+def _put_meta(conn, maxima, stamp=None):
+    items = [("h_max", repr(float(maxima[0]))), ("a_max", repr(float(maxima[1]))),
+             ("f_max", repr(float(maxima[2])))]
+    if stamp is not None:
+        items.append(("raster", stamp))
+    conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", items)
+
+def _stored_maxima(meta):
+    return tuple(float(meta[k]) for k in ("h_max", "a_max", "f_max")) if "h_max" in meta else None
+
+def _maxima(df):
+    return (df["height_ft"].max() or 1, df["area_sqft"].max() or 1,
+            df["fuel_mean"].max() if len(df) else 0)
+
+def sync(bldg_gdf, fuel_path=FUEL_TIF, partial=False, fuel_bounds=None, conn=None):
+    """
+    Bring the store in line with `bldg_gdf` (EPSG:4326, with height_ft/area_sqft).
+    partial=True upserts the given rows only; otherwise ids missing from
+    `bldg_gdf` are deleted. `fuel_bounds` – list of (minx, miny, maxx, maxy)
+    regions where the raster changed; without it a changed raster rescans all.
+    Returns a dict of counts (added, updated, removed, fuel, rescored, rescaled).
+    """
+    own = conn is None
+    conn = conn or get_store()
+    try:
+        meta = _meta(conn)
+        old = pd.read_sql_query(
+            "SELECT bid, geom_sha1, height_ft, area_sqft, fuel_mean FROM buildings",
+            conn, index_col="bid")
+
+        geoms = bldg_gdf.geometry.values
+        new = pd.DataFrame({
+            "geom_sha1": _geom_hashes(geoms),
+            "height_ft": bldg_gdf["height_ft"].to_numpy(dtype=float),
+            "area_sqft": bldg_gdf["area_sqft"].to_numpy(dtype=float),
+        }, index=pd.Index(building_ids(bldg_gdf), name="bid"))
+        new = new[~new.index.duplicated(keep="last")]
+        pos = pd.Series(np.arange(len(bldg_gdf)), index=building_ids(bldg_gdf))
+        pos = pos[~pos.index.duplicated(keep="last")]
+
+        prev = old.reindex(new.index)
+        is_new = prev["geom_sha1"].isna().to_numpy()
+        moved = ~is_new & (prev["geom_sha1"] != new["geom_sha1"]).to_numpy()
+        changed = is_new | moved | (
+            (prev["height_ft"] != new["height_ft"]) | (prev["area_sqft"] != new["area_sqft"])
+        ).to_numpy()
+
+        # Which buildings need zonal stats
+        stamp = raster_stamp(fuel_path)
+        need_fuel = is_new | moved
+        if meta.get("raster") != stamp:
+            if fuel_bounds is None or "raster" not in meta:
+                need_fuel[:] = True
+            else:
+                hit = np.zeros(len(new), dtype=bool)
+                for b in fuel_bounds:
+                    hit |= shapely.intersects(geoms[pos.to_numpy()], shapely.box(*b))
+                need_fuel |= hit
+        new["fuel_mean"] = prev["fuel_mean"].to_numpy()
+        if need_fuel.any():
+            fuel = compute_fuel_mean(geoms[pos.to_numpy()[need_fuel]], fuel_path)
+            fuel_changed = new["fuel_mean"].to_numpy()[need_fuel] != fuel
+            new.loc[need_fuel, "fuel_mean"] = fuel
+            changed[np.flatnonzero(need_fuel)[fuel_changed]] = True
+
+        # Combined table after the sync
+        if partial:
+            kept = old.drop(index=new.index, errors="ignore")
+            removed = []
+        else:
+            removed = old.index.difference(new.index).tolist()
+            kept = None
+        full = new if kept is None or kept.empty else pd.concat([kept, new])
+
+        maxima = _maxima(full)
+        rescale = _stored_maxima(meta) != maxima
+        rows = full if rescale else new[changed]
+        vul = score(rows["height_ft"].to_numpy(), rows["area_sqft"].to_numpy(),
+                    rows["fuel_mean"].to_numpy(), maxima)
+
+        with conn:
+            conn.executemany("DELETE FROM buildings WHERE bid = ?", [(b,) for b in removed])
+            conn.executemany(
+                """INSERT INTO buildings (bid, geom_sha1, height_ft, area_sqft, fuel_mean, vulnerability)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(bid) DO UPDATE SET geom_sha1 = excluded.geom_sha1,
+                       height_ft = excluded.height_ft, area_sqft = excluded.area_sqft,
+                       fuel_mean = excluded.fuel_mean, vulnerability = excluded.vulnerability""",
+                zip(rows.index, rows["geom_sha1"], rows["height_ft"].astype(float),
+                    rows["area_sqft"].astype(float), rows["fuel_mean"].astype(float),
+                    vul.astype(float)))
+            _put_meta(conn, maxima, stamp)
+        return {"added": int(is_new.sum()), "updated": int((changed & ~is_new).sum()),
+                "removed": len(removed), "fuel": int(need_fuel.sum()),
+                "rescored": len(rows), "rescaled": rescale}
+    finally:
+        if own:
+            conn.close()
+
+def update_buildings(bldg_gdf, fuel_path=FUEL_TIF):
+    """Upsert a handful of edited/new buildings without touching the rest."""
+    return sync(bldg_gdf, fuel_path, partial=True)
+
+def refresh_fuel(fuel_bounds, bldg_gdf, fuel_path=FUEL_TIF):
+    """After a local raster update: rescan only buildings inside `fuel_bounds`."""
+    return sync(bldg_gdf, fuel_path, fuel_bounds=fuel_bounds)
+
+def remove_buildings(ids):
+    conn = get_store()
+    try:
+        with conn:
+            conn.executemany("DELETE FROM buildings WHERE bid = ?", [(str(b),) for b in ids])
+        # Removing the tallest/largest building changes the maxima for everyone
+        df = pd.read_sql_query("SELECT bid, height_ft, area_sqft, fuel_mean FROM buildings",
+                               conn, index_col="bid")
+        maxima = _maxima(df)
+        if _stored_maxima(_meta(conn)) != maxima:
+            vul = score(df["height_ft"].to_numpy(), df["area_sqft"].to_numpy(),
+                        df["fuel_mean"].to_numpy(), maxima)
+            with conn:
+                conn.executemany("UPDATE buildings SET vulnerability = ? WHERE bid = ?",
+                                 zip(vul.astype(float), df.index))
+                _put_meta(conn, maxima)
+    finally:
+        conn.close()
+
+def vulnerability_for(ids, conn=None):
+    """Stored scores for `ids` (NaN for unknown ids), in the given order."""
+    own = conn is None
+    conn = conn or get_store()
+    try:
+        df = pd.read_sql_query("SELECT bid, vulnerability FROM buildings", conn, index_col="bid")
+    finally:
+        if own:
+            conn.close()
+    return df["vulnerability"].reindex([str(i) for i in ids]).to_numpy()